@@ -0,0 +1,70 @@
+"""Cached Firebase ID-token verification.
+
+Verified tokens are kept in memory keyed by a SHA-256 of the raw token, so a
+client that repeats the same bearer token only pays for a hash and a dict
+lookup. A cached entry never outlives the token's own `exp` claim.
+"""
+import asyncio
+import hashlib
+import os
+import time
+
+from firebase_admin import auth
+
+from cache import TTLCache
+from data_access import run_blocking
+
+# Public certs used to sign Firebase ID tokens
+ID_TOKEN_CERT_URL = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+
+# Drop cached tokens slightly before Firebase itself would reject them
+EXPIRY_LEEWAY_SECONDS = 30
+
+KEY_REFRESH_INTERVAL = float(os.getenv("AUTH_KEY_REFRESH_INTERVAL", "300"))
+
+token_cache = TTLCache(
+    maxsize=int(os.getenv("TOKEN_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("TOKEN_CACHE_MAX_TTL", "600")),
+)
+
+
+def _token_key(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+async def verify_id_token(token: str) -> dict:
+    """Return the decoded token, verifying it with Firebase only on a cache miss"""
+    key = _token_key(token)
+    decoded = token_cache.get(key)
+    if decoded is not None:
+        return decoded
+
+    decoded = await run_blocking(auth.verify_id_token, token)
+    remaining = decoded.get("exp", 0) - time.time() - EXPIRY_LEEWAY_SECONDS
+    if remaining > 0:
+        token_cache.set(key, decoded, ttl=min(remaining, token_cache.ttl))
+    return decoded
+
+
+def forget_user_tokens(uid: str):
+    """Drop every cached token for a user, e.g. after their refresh tokens are revoked"""
+    token_cache.invalidate_where(lambda _, decoded: decoded.get("uid") == uid)
+
+
+def _refresh_signing_keys():
+    # Go through the SDK's own caching HTTP session so verify_id_token finds
+    # the certs already fresh instead of fetching them on a request path
+    verifier = auth._get_client(None)._token_verifier
+    verifier.request(ID_TOKEN_CERT_URL, method="GET")
+
+
+async def refresh_signing_keys_forever():
+    """Background task that keeps Google's token signing certs warm"""
+    while True:
+        try:
+            await run_blocking(_refresh_signing_keys)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Signing key refresh failed: {e}")
+        await asyncio.sleep(KEY_REFRESH_INTERVAL)
@@ -0,0 +1,165 @@
+"""AI study-buddy conversation storage.
+
+`ai_conversations/{id}` holds only a small header (owner, class, preview,
+message_count, timestamps). Messages are append-only documents in the
+`messages` subcollection, ids zero-padded by sequence number, each with its
+own `created_at`. Appends run in a transaction on the header, so concurrent
+turns get distinct sequence numbers instead of overwriting each other.
+
+Once a conversation outgrows the prompt budget, its oldest turns are folded
+into a running `summary` on the header; `summarized_until` is the first seq
+not covered by it, so each compaction only summarises the newly evicted turns.
+
+Conversations written before this layout keep a `messages` array on the
+header. They are still read correctly, and `python migrations.py
+migrate-conversation-messages` moves them over.
+"""
+import asyncio
+import datetime
+import os
+from typing import Dict, List, Optional
+
+from firebase_admin import firestore
+
+from data_access import run_blocking, get_doc, query_docs
+
+MESSAGES_SUBCOLLECTION = "messages"
+
+# Most recent messages loaded to build a prompt
+HISTORY_WINDOW = int(os.getenv("AI_HISTORY_WINDOW", "20"))
+
+PREVIEW_LENGTH = 100
+
+
+def message_id(seq: int) -> str:
+    return f"{seq:08d}"
+
+
+def _legacy_messages(header: Optional[dict]) -> List[dict]:
+    """Non-system messages still stored inline on a pre-subcollection header"""
+    if not header:
+        return []
+    return [m for m in header.get("messages", []) if m.get("role") != "system"]
+
+
+def _message_count(header: Optional[dict]) -> int:
+    if not header:
+        return 0
+    if "message_count" in header:
+        return header["message_count"]
+    return len(_legacy_messages(header))
+
+
+def _preview(messages: List[dict]) -> str:
+    for msg in messages:
+        if msg.get("role") == "user":
+            return msg.get("content", "")[:PREVIEW_LENGTH] + "..."
+    return ""
+
+
+async def load_conversation(conv_ref, limit: int = HISTORY_WINDOW):
+    """Return (header or None, most recent `limit` messages in chronological order)"""
+    recent_query = (conv_ref.collection(MESSAGES_SUBCOLLECTION)
+                    .order_by("seq", direction=firestore.Query.DESCENDING)
+                    .limit(limit))
+    conv_doc, recent_docs = await asyncio.gather(get_doc(conv_ref), query_docs(recent_query))
+    header = conv_doc.to_dict() if conv_doc.exists else None
+
+    messages = [d.to_dict() for d in reversed(recent_docs)]
+    if len(messages) < limit:
+        # Older turns may still live in a legacy inline array; they hold seq 0..n-1
+        legacy = [{**m, "seq": seq} for seq, m in enumerate(_legacy_messages(header))]
+        messages = legacy[-(limit - len(messages)):] + messages
+    return header, messages
+
+
+def unsummarized_messages(header: Optional[dict], messages: List[dict]) -> List[dict]:
+    """Drop messages already folded into the header's running summary"""
+    summarized_until = (header or {}).get("summarized_until", 0)
+    return [m for m in messages if m.get("seq", 0) >= summarized_until]
+
+
+async def load_unsummarized(conv_ref, header: Optional[dict]) -> List[dict]:
+    """Every message not yet folded into the running summary, oldest first"""
+    summarized_until = (header or {}).get("summarized_until", 0)
+    query = (conv_ref.collection(MESSAGES_SUBCOLLECTION)
+             .where("seq", ">=", summarized_until).order_by("seq"))
+    docs = await query_docs(query)
+    legacy = [{**m, "seq": seq} for seq, m in enumerate(_legacy_messages(header))]
+    return legacy[summarized_until:] + [d.to_dict() for d in docs]
+
+
+async def get_all_messages(conv_ref, header: dict) -> List[dict]:
+    """Every message in a conversation, oldest first"""
+    docs = await query_docs(conv_ref.collection(MESSAGES_SUBCOLLECTION).order_by("seq"))
+    return _legacy_messages(header) + [d.to_dict() for d in docs]
+
+
+def summarize_header(header: dict) -> Dict:
+    """Preview and message count for conversation listings"""
+    return {
+        "preview": header.get("preview") or _preview(_legacy_messages(header)),
+        "message_count": _message_count(header),
+    }
+
+
+def _append_messages_sync(db, conv_ref, messages: List[dict], header_fields: dict):
+    transaction = db.transaction()
+
+    @firestore.transactional
+    def append(transaction):
+        snapshot = conv_ref.get(transaction=transaction)
+        header = snapshot.to_dict() if snapshot.exists else None
+        seq = _message_count(header)
+        now = datetime.datetime.utcnow()
+
+        for msg in messages:
+            transaction.set(conv_ref.collection(MESSAGES_SUBCOLLECTION).document(message_id(seq)), {
+                "role": msg["role"],
+                "content": msg["content"],
+                "seq": seq,
+                "created_at": msg.get("created_at") or now,
+            })
+            seq += 1
+
+        update = {
+            **header_fields,
+            "conversation_id": conv_ref.id,
+            "message_count": seq,
+            "last_updated": now,
+        }
+        if header is None:
+            update["created_at"] = now
+        if not (header or {}).get("preview"):
+            update["preview"] = _preview(_legacy_messages(header) + messages)
+        transaction.set(conv_ref, update, merge=True)
+
+    append(transaction)
+
+
+async def append_messages(db, conv_ref, messages: List[dict], **header_fields):
+    """Append messages to the conversation and update its header atomically"""
+    await run_blocking(_append_messages_sync, db, conv_ref, messages, header_fields)
+
+
+def _save_summary_sync(db, conv_ref, summary: str, summarized_until: int):
+    transaction = db.transaction()
+
+    @firestore.transactional
+    def save(transaction):
+        snapshot = conv_ref.get(transaction=transaction)
+        header = snapshot.to_dict() if snapshot.exists else {}
+        # A concurrent turn may already have compacted further; never move backwards
+        if header.get("summarized_until", 0) >= summarized_until:
+            return
+        transaction.set(conv_ref, {
+            "summary": summary,
+            "summarized_until": summarized_until,
+        }, merge=True)
+
+    save(transaction)
+
+
+async def save_summary(db, conv_ref, summary: str, summarized_until: int):
+    """Store the running summary covering every message with seq < summarized_until"""
+    await run_blocking(_save_summary_sync, db, conv_ref, summary, summarized_until)
@@ -0,0 +1,298 @@
+"""Async data access for Firestore.
+
+The Admin SDK client is synchronous, so every call is pushed onto a bounded
+thread pool instead of running on the event loop thread. Endpoints should only
+touch Firestore through these helpers.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from functools import partial
+from typing import Dict, Iterable, Optional
+
+from firebase_admin import firestore
+
+from cache import TTLCache
+
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("FIRESTORE_IO_WORKERS", "32")),
+    thread_name_prefix="firestore-io",
+)
+
+# Max documents per batched users multi-get; chunks are fetched in parallel
+USER_LOOKUP_CHUNK_SIZE = int(os.getenv("USER_LOOKUP_CHUNK_SIZE", "100"))
+
+# Firestore caps a WriteBatch at 500 operations
+BATCH_LIMIT = 500
+
+
+class ReadCounter:
+    """Number of Firestore documents read while handling one request"""
+    __slots__ = ("reads",)
+
+    def __init__(self):
+        self.reads = 0
+
+
+_read_counter: ContextVar[Optional[ReadCounter]] = ContextVar("firestore_read_counter", default=None)
+
+
+def track_reads() -> ReadCounter:
+    """Start counting document reads for the current request context"""
+    counter = ReadCounter()
+    _read_counter.set(counter)
+    return counter
+
+
+def _count_reads(n: int):
+    counter = _read_counter.get()
+    if counter is not None:
+        counter.reads += n
+
+
+# Short-lived shared cache of users/{uid}.full_name used to hydrate post authors
+author_name_cache = TTLCache(
+    maxsize=int(os.getenv("AUTHOR_CACHE_SIZE", "5000")),
+    ttl=float(os.getenv("AUTHOR_CACHE_TTL", "60")),
+)
+
+# classMembers records keyed by (class_id, uid); None caches "not a member".
+# Writes on this instance update it directly; MEMBERSHIP_CACHE_TTL bounds how
+# stale it can be with respect to writes made by other instances.
+membership_cache = TTLCache(
+    maxsize=int(os.getenv("MEMBERSHIP_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("MEMBERSHIP_CACHE_TTL", "30")),
+)
+_NOT_CACHED = object()
+
+# Class name plus the newest post headlines that make up the AI class context,
+# keyed by class_id; None caches "no such class". Post creation and class
+# deletion on this instance update it in place; the TTL picks up other instances.
+class_context_cache = TTLCache(
+    maxsize=int(os.getenv("CLASS_CONTEXT_CACHE_SIZE", "2000")),
+    ttl=float(os.getenv("CLASS_CONTEXT_CACHE_TTL", "300")),
+)
+CLASS_CONTEXT_POSTS = 3
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Run a blocking call (Firestore, Firebase Auth) on the I/O thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(fn, *args, **kwargs))
+
+
+async def get_doc(ref):
+    """Fetch a single document snapshot"""
+    _count_reads(1)
+    return await run_blocking(ref.get)
+
+
+async def query_docs(query) -> list:
+    """Run a query and return all matching snapshots"""
+    docs = await run_blocking(lambda: list(query.stream()))
+    # Firestore bills at least one read even for an empty result
+    _count_reads(max(len(docs), 1))
+    return docs
+
+
+async def count_docs(query) -> int:
+    """Server-side count of a query's matches"""
+    # Count aggregations bill one read per batch of up to 1000 index entries
+    result = await run_blocking(lambda: query.count().get())
+    count = result[0][0].value
+    _count_reads(max(1, -(-count // 1000)))
+    return count
+
+
+async def get_docs(db, refs: list) -> dict:
+    """Fetch many documents from one collection in a single multi-get, keyed by doc id"""
+    if not refs:
+        return {}
+    _count_reads(len(refs))
+    snapshots = await run_blocking(lambda: list(db.get_all(refs)))
+    return {snap.id: snap for snap in snapshots}
+
+
+async def set_doc(ref, data: dict, merge: bool = False):
+    await run_blocking(ref.set, data, merge=merge)
+
+
+async def update_doc(ref, data: dict):
+    await run_blocking(ref.update, data)
+
+
+async def delete_doc(ref):
+    await run_blocking(ref.delete)
+
+
+class BatchWriter:
+    """Queue set/update/delete writes and commit them in WriteBatches of at most BATCH_LIMIT.
+
+    Blocking: use it inside run_blocking, or directly from scripts. Call
+    flush() at the end to commit the final partial batch. Writes are atomic
+    only within one batch.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._batch = db.batch()
+        self.pending = 0
+
+    def set(self, ref, data: dict, merge: bool = False):
+        self._batch.set(ref, data, merge=merge)
+        self._added()
+
+    def update(self, ref, data: dict):
+        self._batch.update(ref, data)
+        self._added()
+
+    def delete(self, ref):
+        self._batch.delete(ref)
+        self._added()
+
+    def _added(self):
+        self.pending += 1
+        if self.pending >= BATCH_LIMIT:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self._batch.commit()
+            self._batch = self._db.batch()
+            self.pending = 0
+
+
+def _delete_refs_sync(db, refs: list):
+    writer = BatchWriter(db)
+    for ref in refs:
+        writer.delete(ref)
+    writer.flush()
+
+
+async def delete_refs(db, refs: Iterable):
+    """Delete many documents in as few batched commits as possible"""
+    await run_blocking(_delete_refs_sync, db, list(refs))
+
+
+async def get_membership(db, class_id: str, uid: str) -> Optional[dict]:
+    """Return the classMembers record for (class_id, uid), or None if not a member"""
+    cached = membership_cache.get((class_id, uid), _NOT_CACHED)
+    if cached is not _NOT_CACHED:
+        return cached
+    doc = await get_doc(db.collection("classMembers").document(f"{class_id}_{uid}"))
+    member = doc.to_dict() if doc.exists else None
+    membership_cache.set((class_id, uid), member)
+    return member
+
+
+def remember_membership(class_id: str, uid: str, member: Optional[dict]):
+    """Write-through after creating (member dict) or deleting (None) a classMembers doc"""
+    membership_cache.set((class_id, uid), member)
+
+
+def forget_class_memberships(class_id: str):
+    """Drop every cached membership for a class, e.g. after it is deleted"""
+    membership_cache.invalidate_where(lambda key, _: key[0] == class_id)
+
+
+async def get_class_context_info(db, class_id: str) -> Optional[dict]:
+    """{"name", "recent_posts": [{"title", "post_type"}, ...]} for a class, or None if it doesn't exist
+    or is being deleted"""
+    cached = class_context_cache.get(class_id, _NOT_CACHED)
+    if cached is not _NOT_CACHED:
+        return cached
+
+    class_ref = db.collection("classes").document(class_id)
+    class_doc, recent_posts = await asyncio.gather(
+        get_doc(class_ref),
+        query_docs(class_ref.collection("posts")
+                   .order_by("createdAt", direction=firestore.Query.DESCENDING)
+                   .limit(CLASS_CONTEXT_POSTS))
+    )
+    info = None
+    if class_doc.exists and not class_doc.to_dict().get("deleting"):
+        info = {
+            "name": class_doc.to_dict().get("name", ""),
+            "recent_posts": [_post_headline(post.to_dict()) for post in recent_posts],
+        }
+    class_context_cache.set(class_id, info)
+    return info
+
+
+def _post_headline(post: dict) -> dict:
+    return {"title": post.get("title", "Untitled"), "post_type": post.get("post_type", "discussion")}
+
+
+def remember_class(class_id: str, name: str):
+    """Seed the context cache for a newly created class"""
+    class_context_cache.set(class_id, {"name": name, "recent_posts": []})
+
+
+def remember_class_post(class_id: str, post: dict):
+    """Put a newly created post at the front of the cached class context, if cached"""
+    info = class_context_cache.get(class_id)
+    if info is not None:
+        info["recent_posts"] = ([_post_headline(post)] + info["recent_posts"])[:CLASS_CONTEXT_POSTS]
+
+
+def forget_class(class_id: str):
+    """Cache a deleted class as missing"""
+    class_context_cache.set(class_id, None)
+
+
+async def get_user_profiles(db, uids: Iterable[str]) -> Dict[str, dict]:
+    """Resolve users/{uid} profiles in chunked multi-gets that run in parallel.
+
+    Unknown uids are left out of the result. Fetched names also warm the
+    author name cache.
+    """
+    unique = list(dict.fromkeys(uid for uid in uids if uid))
+    chunks = [unique[i:i + USER_LOOKUP_CHUNK_SIZE] for i in range(0, len(unique), USER_LOOKUP_CHUNK_SIZE)]
+    results = await asyncio.gather(*[
+        get_docs(db, [db.collection("users").document(uid) for uid in chunk]) for chunk in chunks
+    ])
+
+    profiles = {}
+    for snapshots in results:
+        for uid, snap in snapshots.items():
+            if snap.exists:
+                profiles[uid] = snap.to_dict()
+                author_name_cache.set(uid, profiles[uid].get("full_name", "Unknown"))
+    return profiles
+
+
+async def get_author_names(db, uids: Iterable[str]) -> Dict[str, str]:
+    """Resolve display names for uids; cache misses go through get_user_profiles"""
+    names = {}
+    missing = []
+    for uid in set(filter(None, uids)):
+        name = author_name_cache.get(uid)
+        if name is None:
+            missing.append(uid)
+        else:
+            names[uid] = name
+
+    if missing:
+        profiles = await get_user_profiles(db, missing)
+        for uid in missing:
+            names[uid] = profiles.get(uid, {}).get("full_name", "Unknown")
+            author_name_cache.set(uid, names[uid])
+    return names
+
+
+def invalidate_user(uid: str):
+    """Drop cached profile data after a users/{uid} write"""
+    author_name_cache.invalidate(uid)
+
+
+def cache_stats() -> dict:
+    return {
+        "membership": membership_cache.stats(),
+        "author_names": author_name_cache.stats(),
+        "class_context": class_context_cache.stats(),
+    }
+
+
+def shutdown():
+    _executor.shutdown(wait=False)
@@ -0,0 +1,179 @@
+"""Grade storage with materialised per-student aggregates.
+
+Raw grades live in `classes/{class_id}/grades/{assignment_id}_{student_id}`.
+Alongside them, `classes/{class_id}/gradeAggregates/{student_id}` holds the
+student's grades keyed by assignment plus a running sum, count and mean, so a
+student's grade summary is a single document read.
+
+Grades and aggregates are written together in a transaction. An overwrite
+replaces the assignment's entry in the aggregate, so it is never counted twice.
+`python migrations.py rebuild-grade-aggregates` recomputes every aggregate
+from the raw grades.
+"""
+import asyncio
+import datetime
+import math
+from typing import Dict, Iterable, List, Optional
+
+from firebase_admin import firestore
+
+from data_access import run_blocking, get_doc, get_docs, query_docs, BatchWriter, BATCH_LIMIT
+
+GRADES_SUBCOLLECTION = "grades"
+AGGREGATES_SUBCOLLECTION = "gradeAggregates"
+
+
+def grade_ref(db, class_id: str, assignment_id: str, student_id: str):
+    return (db.collection("classes").document(class_id)
+            .collection(GRADES_SUBCOLLECTION).document(f"{assignment_id}_{student_id}"))
+
+
+def aggregate_ref(db, class_id: str, student_id: str):
+    return (db.collection("classes").document(class_id)
+            .collection(AGGREGATES_SUBCOLLECTION).document(student_id))
+
+
+def build_aggregate(student_id: str, entries: Dict[str, dict]) -> dict:
+    """Aggregate doc for {assignment_id: {"grade", "updatedAt"}}"""
+    numeric = [e["grade"] for e in entries.values() if isinstance(e.get("grade"), (int, float))]
+    total = float(sum(numeric))
+    return {
+        "studentId": student_id,
+        "grades": entries,
+        "sum": total,
+        "count": len(numeric),
+        "mean": total / len(numeric) if numeric else None,
+        "updatedAt": datetime.datetime.utcnow(),
+    }
+
+
+def _entries_from_grade_docs(grade_docs: Iterable[dict]) -> Dict[str, dict]:
+    return {g["assignmentId"]: {"grade": g.get("grade"), "updatedAt": g.get("updatedAt")} for g in grade_docs}
+
+
+def aggregate_from_grade_docs(student_id: str, grade_docs: Iterable[dict]) -> dict:
+    return build_aggregate(student_id, _entries_from_grade_docs(grade_docs))
+
+
+def _student_grades_query(db, class_id: str, student_id: str):
+    return (db.collection("classes").document(class_id)
+            .collection(GRADES_SUBCOLLECTION).where("studentId", "==", student_id))
+
+
+def grade_doc(assignment_id: str, student_id: str, grade: float, updated_by: str, now: datetime.datetime) -> dict:
+    return {
+        "assignmentId": assignment_id,
+        "studentId": student_id,
+        "grade": grade,
+        "updatedAt": now,
+        "updatedBy": updated_by,
+    }
+
+
+def _set_grades_sync(db, class_id: str, student_id: str, grades: Dict[str, float], updated_by: str):
+    transaction = db.transaction()
+    agg_ref = aggregate_ref(db, class_id, student_id)
+
+    @firestore.transactional
+    def write(transaction):
+        snapshot = agg_ref.get(transaction=transaction)
+        if snapshot.exists:
+            entries = dict(snapshot.to_dict().get("grades", {}))
+        else:
+            # No aggregate yet: seed it with any grades written before aggregates existed
+            legacy = transaction.get(_student_grades_query(db, class_id, student_id))
+            entries = _entries_from_grade_docs(d.to_dict() for d in legacy)
+        now = datetime.datetime.utcnow()
+        for assignment_id, grade in grades.items():
+            transaction.set(grade_ref(db, class_id, assignment_id, student_id),
+                            grade_doc(assignment_id, student_id, grade, updated_by, now))
+            entries[assignment_id] = {"grade": grade, "updatedAt": now}
+        transaction.set(agg_ref, build_aggregate(student_id, entries))
+
+    write(transaction)
+
+
+def check_finite(grades: Dict[str, float]):
+    """Raise ValueError for NaN/inf grades, which would poison the aggregate's sum and mean"""
+    for assignment_id, grade in grades.items():
+        if not math.isfinite(grade):
+            raise ValueError(f"Grade for {assignment_id} must be a finite number")
+
+
+async def set_grades(db, class_id: str, student_id: str, grades: Dict[str, float], updated_by: str):
+    """Write {assignment_id: grade} for one student and update their aggregate atomically"""
+    check_finite(grades)
+    await run_blocking(_set_grades_sync, db, class_id, student_id, grades, updated_by)
+
+
+def _commit_batch(db, writes: List[tuple]):
+    writer = BatchWriter(db)
+    for ref, data in writes:
+        writer.set(ref, data)
+    writer.flush()
+
+
+async def import_grades(db, class_id: str, grades_by_student: Dict[str, Dict[str, float]],
+                        updated_by: str) -> Dict[str, str]:
+    """Bulk-write {student_id: {assignment_id: grade}} with one aggregate update per student.
+
+    Current aggregates are read in one multi-get, then grade docs and updated
+    aggregates go out in parallel WriteBatch commits. Students are packed
+    whole into batches, so each is updated atomically, except a student with
+    more than BATCH_LIMIT - 1 grades: theirs get a batch sequence of their own
+    with the aggregate written last. Unlike set_grades this is not a
+    transaction: a single grade set concurrently for the same student may be
+    lost from the aggregate until the next write or rebuild.
+
+    Returns {student_id: error} for students whose batch failed to commit.
+    """
+    for student_grades in grades_by_student.values():
+        check_finite(student_grades)
+    student_ids = list(grades_by_student)
+    snapshots = await get_docs(db, [aggregate_ref(db, class_id, sid) for sid in student_ids])
+    current_entries = {sid: dict(snap.to_dict().get("grades", {}))
+                       for sid, snap in snapshots.items() if snap.exists}
+
+    missing = {sid: [] for sid in student_ids if sid not in current_entries}
+    if missing:
+        # Seed new aggregates with grades written before aggregates existed, from one scan
+        scan = db.collection("classes").document(class_id).collection(GRADES_SUBCOLLECTION)
+        for gdoc in await query_docs(scan):
+            g = gdoc.to_dict()
+            if g.get("studentId") in missing:
+                missing[g["studentId"]].append(g)
+        for sid, grade_docs in missing.items():
+            current_entries[sid] = _entries_from_grade_docs(grade_docs)
+
+    now = datetime.datetime.utcnow()
+    batches, current, current_students = [], [], []
+    for student_id in student_ids:
+        entries = current_entries[student_id]
+        writes = []
+        for assignment_id, grade in grades_by_student[student_id].items():
+            writes.append((grade_ref(db, class_id, assignment_id, student_id),
+                           grade_doc(assignment_id, student_id, grade, updated_by, now)))
+            entries[assignment_id] = {"grade": grade, "updatedAt": now}
+        writes.append((aggregate_ref(db, class_id, student_id), build_aggregate(student_id, entries)))
+
+        if current and len(current) + len(writes) > BATCH_LIMIT:
+            batches.append((current_students, current))
+            current, current_students = [], []
+        current.extend(writes)
+        current_students.append(student_id)
+    if current:
+        batches.append((current_students, current))
+
+    results = await asyncio.gather(*(run_blocking(_commit_batch, db, writes) for _, writes in batches),
+                                   return_exceptions=True)
+    failed = {}
+    for (batch_students, _), result in zip(batches, results):
+        if isinstance(result, Exception):
+            for student_id in batch_students:
+                failed[student_id] = f"{type(result).__name__}: {result}"
+    return failed
+
+
+async def get_aggregate(db, class_id: str, student_id: str) -> Optional[dict]:
+    doc = await get_doc(aggregate_ref(db, class_id, student_id))
+    return doc.to_dict() if doc.exists else None
@@ -0,0 +1,252 @@
+"""CPU-bound document and image processing, run in a managed process pool.
+
+PyPDF2 parsing and image decoding/re-encoding are pure-Python work that would otherwise
+block the event loop. Task functions here take and return plain bytes/str so
+they pickle cheaply. The pool:
+
+- rejects new work with IngestBusy once INGEST_MAX_PENDING tasks are in flight,
+- runs at most one task per worker at a time, so INGEST_TASK_TIMEOUT counts
+  only time spent running, not time queued behind other tasks,
+- fails tasks that exceed INGEST_TASK_TIMEOUT with IngestTimeout and replaces
+  just that worker, since a stuck parse cannot be interrupted,
+- recycles each worker after INGEST_RECYCLE_AFTER tasks to bound memory growth
+  from large documents.
+"""
+import asyncio
+import base64
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+import PyPDF2
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from prompt_builder import count_tokens, load_encoding
+
+# Longest edge sent to the vision model; OpenAI downsamples beyond ~2048px anyway
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1536"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+SUPPORTED_IMAGE_FORMATS = {"JPEG", "PNG", "WEBP", "GIF", "BMP", "TIFF", "MPO"}
+
+
+class IngestBusy(Exception):
+    """The pool already has INGEST_MAX_PENDING tasks in flight"""
+
+
+class IngestTimeout(Exception):
+    """A task ran longer than INGEST_TASK_TIMEOUT"""
+
+
+def iter_pdf_text(stream, max_chars: Optional[int] = None, max_tokens: Optional[int] = None,
+                  first_page: int = 1, last_page: Optional[int] = None):
+    """Yield page text lazily for pages first_page..last_page (1-based, inclusive).
+
+    Stops parsing as soon as `max_chars` characters (the last page is trimmed)
+    or `max_tokens` tokens (the last page is yielded whole) have been produced.
+    """
+    if max_tokens is not None:
+        # Blocking is fine in a worker process, which needs its own copy of the encoding
+        load_encoding()
+    pdf_reader = PyPDF2.PdfReader(stream)
+    stop = len(pdf_reader.pages) if last_page is None else min(last_page, len(pdf_reader.pages))
+    chars = tokens = 0
+    for index in range(max(first_page, 1) - 1, stop):
+        text = (pdf_reader.pages[index].extract_text() or "") + "\n"
+        if max_chars is not None and chars + len(text) >= max_chars:
+            yield text[:max_chars - chars]
+            return
+        yield text
+        chars += len(text)
+        if max_tokens is not None:
+            tokens += count_tokens(text)
+            if tokens >= max_tokens:
+                return
+
+
+def pdf_text(data: bytes, max_chars: Optional[int] = None, max_tokens: Optional[int] = None,
+             first_page: int = 1, last_page: Optional[int] = None) -> str:
+    return "".join(iter_pdf_text(io.BytesIO(data), max_chars, max_tokens, first_page, last_page))
+
+
+def image_format(data: bytes) -> str:
+    """Pillow's name for the image format of `data`, read from its header only.
+    Raises ValueError unless it is one of SUPPORTED_IMAGE_FORMATS."""
+    try:
+        image_format = Image.open(io.BytesIO(data)).format
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f"Not a readable image: {e}")
+    if image_format not in SUPPORTED_IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image format: {image_format}")
+    return image_format
+
+
+def normalize_image(data: bytes, max_dimension: int = IMAGE_MAX_DIMENSION, quality: int = IMAGE_QUALITY) -> str:
+    """Re-encode an uploaded image for a vision request and return it as a data URL.
+
+    The real format is detected from the bytes rather than the file name. The
+    image is rotated per its EXIF orientation, downscaled to fit
+    `max_dimension`, and saved without metadata as JPEG, or WebP when it has
+    transparency. Raises ValueError for anything Pillow cannot decode.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.format not in SUPPORTED_IMAGE_FORMATS:
+            raise ValueError(f"Unsupported image format: {image.format}")
+        # Let the JPEG decoder skip straight to a reduced scale instead of decoding full size
+        image.draft("RGB", (max_dimension, max_dimension))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f"Could not read image: {e}")
+
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    output = io.BytesIO()
+    if has_alpha:
+        image.convert("RGBA").save(output, format="WEBP", quality=quality, method=4)
+        mime_type = "image/webp"
+    else:
+        image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+        mime_type = "image/jpeg"
+    return f"data:{mime_type};base64,{base64.b64encode(output.getvalue()).decode('utf-8')}"
+
+
+class _Worker:
+    """One worker process, behind its own single-process executor so it can be
+    killed or replaced without touching the other workers"""
+
+    def __init__(self, mp_context):
+        self.executor = ProcessPoolExecutor(max_workers=1, mp_context=mp_context)
+        self.tasks = 0
+
+    def retire(self, kill: bool):
+        """Stop taking work; with `kill`, end the process now instead of after its current task"""
+        if kill:
+            # ProcessPoolExecutor has no public way to stop a running task
+            for process in list(getattr(self.executor, "_processes", {}).values()):
+                process.terminate()
+        self.executor.shutdown(wait=False, cancel_futures=kill)
+
+
+class IngestPool:
+    def __init__(self, workers: int, max_pending: int, task_timeout: float, recycle_after: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.task_timeout = task_timeout
+        self.recycle_after = recycle_after
+        # spawn: forking a process that holds gRPC/Firestore threads is unsafe
+        self._mp_context = multiprocessing.get_context("spawn")
+        self._all = []
+        self._idle = None
+        self.pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.recycles = 0
+
+    @classmethod
+    def from_env(cls) -> "IngestPool":
+        workers = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 2)))
+        return cls(
+            workers=workers,
+            max_pending=int(os.getenv("INGEST_MAX_PENDING", str(workers * 4))),
+            task_timeout=float(os.getenv("INGEST_TASK_TIMEOUT", "30")),
+            recycle_after=int(os.getenv("INGEST_RECYCLE_AFTER", "200")),
+        )
+
+    def _checkout_queue(self) -> asyncio.Queue:
+        if self._idle is None:
+            # Slots start empty; a worker process is spawned on first use
+            self._idle = asyncio.Queue()
+            for _ in range(self.workers):
+                self._idle.put_nowait(None)
+        return self._idle
+
+    def _replace(self, worker: "_Worker", kill: bool) -> "_Worker":
+        worker.retire(kill)
+        self._all.remove(worker)
+        self.recycles += 1
+        return self._new_worker()
+
+    def _new_worker(self) -> "_Worker":
+        worker = _Worker(self._mp_context)
+        self._all.append(worker)
+        return worker
+
+    async def run(self, fn, *args):
+        """Run fn(*args) in a worker process.
+
+        Tasks wait here for an idle worker rather than inside an executor, so
+        the timeout only covers the time a worker actually spends on the task.
+        """
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise IngestBusy()
+
+        self.pending += 1
+        self.submitted += 1
+        idle = self._checkout_queue()
+        worker, checked_out = None, False
+        try:
+            worker = await idle.get()
+            checked_out = True
+            if worker is None:
+                worker = self._new_worker()
+            elif worker.tasks >= self.recycle_after:
+                worker = self._replace(worker, kill=False)
+            worker.tasks += 1
+            future = asyncio.get_running_loop().run_in_executor(worker.executor, fn, *args)
+            try:
+                result = await asyncio.wait_for(future, self.task_timeout)
+            except asyncio.TimeoutError:
+                # Only this worker is stuck; the others keep their tasks
+                self.timeouts += 1
+                worker = self._replace(worker, kill=True)
+                raise IngestTimeout()
+            except BrokenProcessPool:
+                # The worker died (e.g. OOM); its executor is unusable from here on
+                self.failed += 1
+                worker = self._replace(worker, kill=False)
+                raise
+            except asyncio.CancelledError:
+                # The caller went away but the process is still busy: don't hand it out again
+                worker = self._replace(worker, kill=False)
+                raise
+            except Exception:
+                self.failed += 1
+                raise
+        finally:
+            self.pending -= 1
+            if checked_out and idle is self._idle:
+                idle.put_nowait(worker)
+        self.completed += 1
+        return result
+
+    def stats(self) -> dict:
+        idle = self._idle.qsize() if self._idle is not None else self.workers
+        return {
+            "workers": self.workers,
+            "busy": self.workers - idle,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "utilization": round(self.pending / self.max_pending, 4) if self.max_pending else None,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "recycles": self.recycles,
+        }
+
+    def shutdown(self):
+        for worker in self._all:
+            worker.retire(kill=True)
+        self._all = []
+        self._idle = None
+
+
+pool = IngestPool.from_env()
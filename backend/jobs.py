@@ -0,0 +1,280 @@
+"""Local background job queue backed by SQLite.
+
+Long-running work (note analysis, class deletion) is submitted here and run by
+in-process worker tasks, so the HTTP request can return 202 straight away and
+clients poll `GET /api/v1/jobs/{job_id}`. Nothing external is required: jobs
+and their uploaded files live in a SQLite file on the instance (JOB_DB_PATH).
+
+A job whose handler raises is retried with exponential backoff up to
+JOB_MAX_ATTEMPTS times, unless it raises PermanentJobError. Jobs left
+`running` by a crashed or restarted process are picked up again at startup,
+so handlers should be safe to resume.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from data_access import run_blocking
+
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(tempfile.gettempdir(), "classroom_jobs.sqlite3"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "5"))
+# Finished jobs are kept this long for status polling
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", str(24 * 3600)))
+
+# How often idle workers look for due retries
+POLL_INTERVAL = 1.0
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = "queued", "running", "succeeded", "failed", "cancelled"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    user_id TEXT,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    detail TEXT,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, available_at);
+CREATE TABLE IF NOT EXISTS job_files (
+    job_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (job_id, position)
+);
+"""
+
+
+class PermanentJobError(Exception):
+    """Raised by a handler for failures that retrying cannot fix"""
+
+
+class JobCancelled(Exception):
+    """Raised inside a handler once its job has been cancelled"""
+
+
+class Job:
+    """What a handler sees of the job it is running"""
+
+    def __init__(self, queue: "JobQueue", row: sqlite3.Row):
+        self._queue = queue
+        self.id = row["id"]
+        self.kind = row["kind"]
+        self.user_id = row["user_id"]
+        self.attempt = row["attempts"]
+        self.payload = json.loads(row["payload"])
+        self.state = json.loads(row["detail"] or "{}")
+
+    async def files(self) -> List[Tuple[str, bytes]]:
+        """Uploaded (filename, data) pairs in submission order"""
+        return await run_blocking(self._queue._load_files, self.id)
+
+    async def report(self, progress: float, **state):
+        """Record progress (0..1) and resumable handler state; raises JobCancelled if cancelled"""
+        self.state.update(state)
+        status = await run_blocking(self._queue._report, self.id, progress, self.state)
+        if status == CANCELLED:
+            raise JobCancelled()
+
+
+class JobQueue:
+    def __init__(self, path: str = JOB_DB_PATH, workers: int = JOB_WORKERS,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, retry_delay: float = JOB_RETRY_DELAY):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._handlers: Dict[str, Callable[[Job], Awaitable[dict]]] = {}
+        self._conn = None
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._tasks = []
+
+    def register(self, kind: str, handler: Callable[[Job], Awaitable[dict]]):
+        """Handlers return a JSON-serialisable result stored on the job"""
+        self._handlers[kind] = handler
+
+    # --- SQLite (always called on the I/O thread pool) ---
+
+    def _execute(self, sql: str, params=()) -> List[sqlite3.Row]:
+        with self._lock:
+            with self._conn:
+                return self._conn.execute(sql, params).fetchall()
+
+    def _open(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        now = time.time()
+        # Resume jobs interrupted by a restart and drop old finished ones
+        self._execute("UPDATE jobs SET status = ?, available_at = ? WHERE status = ?", (QUEUED, now, RUNNING))
+        expired = [r["id"] for r in self._execute(
+            "SELECT id FROM jobs WHERE status IN (?, ?, ?) AND updated_at < ?",
+            (SUCCEEDED, FAILED, CANCELLED, now - JOB_RETENTION))]
+        for job_id in expired:
+            self._execute("DELETE FROM job_files WHERE job_id = ?", (job_id,))
+            self._execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def _insert(self, job_id: str, kind: str, payload: dict, files, user_id: Optional[str]):
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT INTO jobs (id, kind, user_id, status, payload, available_at, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, kind, user_id, QUEUED, json.dumps(payload), now, now, now))
+                self._conn.executemany(
+                    "INSERT INTO job_files (job_id, position, filename, data) VALUES (?, ?, ?, ?)",
+                    [(job_id, i, name, data) for i, (name, data) in enumerate(files)])
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE status = ? AND available_at <= ? ORDER BY available_at LIMIT 1",
+                    (QUEUED, now)).fetchone()
+                if row is None:
+                    return None
+                # Guard on status in case another process sharing the file claimed it first
+                claimed = self._conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ? WHERE id = ? AND status = ?",
+                    (RUNNING, now, row["id"], QUEUED)).rowcount
+                if not claimed:
+                    return None
+                return self._conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+
+    def _load_files(self, job_id: str) -> List[Tuple[str, bytes]]:
+        rows = self._execute("SELECT filename, data FROM job_files WHERE job_id = ? ORDER BY position", (job_id,))
+        return [(r["filename"], r["data"]) for r in rows]
+
+    def _report(self, job_id: str, progress: float, state: dict) -> Optional[str]:
+        self._execute("UPDATE jobs SET progress = ?, detail = ?, updated_at = ? WHERE id = ? AND status = ?",
+                      (progress, json.dumps(state), time.time(), job_id, RUNNING))
+        rows = self._execute("SELECT status FROM jobs WHERE id = ?", (job_id,))
+        return rows[0]["status"] if rows else None
+
+    def _finish(self, job_id: str, status: str, result=None, error: Optional[str] = None):
+        self._execute("UPDATE jobs SET status = ?, progress = CASE WHEN ? THEN 1 ELSE progress END, "
+                      "result = ?, error = ?, updated_at = ? WHERE id = ? AND status = ?",
+                      (status, status == SUCCEEDED, json.dumps(result) if result is not None else None,
+                       error, time.time(), job_id, RUNNING))
+        self._execute("DELETE FROM job_files WHERE job_id = ?", (job_id,))
+
+    def _retry_later(self, job_id: str, error: str, delay: float):
+        now = time.time()
+        self._execute("UPDATE jobs SET status = ?, error = ?, available_at = ?, updated_at = ? "
+                      "WHERE id = ? AND status = ?", (QUEUED, error, now + delay, now, job_id, RUNNING))
+
+    def _cancel(self, job_id: str) -> bool:
+        self._execute("UPDATE jobs SET status = ?, updated_at = ? WHERE id = ? AND status IN (?, ?)",
+                      (CANCELLED, time.time(), job_id, QUEUED, RUNNING))
+        self._execute("DELETE FROM job_files WHERE job_id = ? AND "
+                      "(SELECT status FROM jobs WHERE id = ?) = ?", (job_id, job_id, CANCELLED))
+        rows = self._execute("SELECT status FROM jobs WHERE id = ?", (job_id,))
+        return bool(rows) and rows[0]["status"] == CANCELLED
+
+    # --- public API ---
+
+    async def submit(self, kind: str, payload: dict, files=(), user_id: Optional[str] = None) -> str:
+        """Queue a job and return its id. `files` is a sequence of (filename, bytes)."""
+        if kind not in self._handlers:
+            raise ValueError(f"No handler registered for job kind {kind!r}")
+        job_id = str(uuid.uuid4())
+        await run_blocking(self._insert, job_id, kind, payload, list(files), user_id)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        rows = await run_blocking(self._execute, "SELECT * FROM jobs WHERE id = ?", (job_id,))
+        if not rows:
+            return None
+        row = rows[0]
+        return {
+            "job_id": row["id"],
+            "kind": row["kind"],
+            "user_id": row["user_id"],
+            "status": row["status"],
+            "progress": row["progress"],
+            "state": json.loads(row["detail"] or "{}"),
+            "attempts": row["attempts"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    async def cancel(self, job_id: str) -> bool:
+        """Cancel a queued or running job; running handlers stop at their next report()"""
+        return await run_blocking(self._cancel, job_id)
+
+    async def _run(self, row: sqlite3.Row):
+        job = Job(self, row)
+        try:
+            result = await self._handlers[job.kind](job)
+        except JobCancelled:
+            return
+        except asyncio.CancelledError:
+            # Shutting down: leave it `running` so the next start resumes it
+            raise
+        except PermanentJobError as e:
+            await run_blocking(self._finish, job.id, FAILED, error=str(e))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if job.attempt >= self.max_attempts:
+                await run_blocking(self._finish, job.id, FAILED, error=error)
+            else:
+                delay = self.retry_delay * 2 ** (job.attempt - 1)
+                await run_blocking(self._retry_later, job.id, error, delay)
+        else:
+            await run_blocking(self._finish, job.id, SUCCEEDED, result=result)
+
+    async def _worker(self):
+        while True:
+            try:
+                row = await run_blocking(self._claim)
+                if row is None:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self._run(row)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Job worker error: {e}")
+                await asyncio.sleep(POLL_INTERVAL)
+
+    async def start(self):
+        await run_blocking(self._open)
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+queue = JobQueue()
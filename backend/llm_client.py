@@ -0,0 +1,97 @@
+import asyncio
+import json
+import os
+from typing import Optional
+
+import httpx
+
+
+class LLMClient:
+    """Shared async client for OpenAI chat completions.
+
+    One keep-alive connection pool is reused by every request, and a global
+    semaphore caps how many completions can be in flight at once.
+    """
+
+    def __init__(self, api_url: str,
+                 connect_timeout: float = 5.0,
+                 read_timeout: float = 60.0,
+                 max_connections: int = 20,
+                 max_keepalive_connections: int = 10,
+                 max_concurrency: int = 16):
+        self.api_url = api_url
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+        )
+        self.max_concurrency = max_concurrency
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @classmethod
+    def from_env(cls, api_url: str) -> "LLMClient":
+        """Build a client using OPENAI_* environment overrides"""
+        return cls(
+            api_url,
+            connect_timeout=float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5")),
+            read_timeout=float(os.getenv("OPENAI_READ_TIMEOUT", "60")),
+            max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", "20")),
+            max_keepalive_connections=int(os.getenv("OPENAI_MAX_KEEPALIVE", "10")),
+            max_concurrency=int(os.getenv("OPENAI_MAX_CONCURRENCY", "16")),
+        )
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Created lazily so the pool is bound to the running event loop
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    @staticmethod
+    def _headers(api_key: str) -> dict:
+        return {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+
+    async def chat_completion(self, payload: dict, api_key: str) -> dict:
+        """POST a chat completion and return the decoded JSON body"""
+        async with self.semaphore:
+            response = await self.client.post(self.api_url, headers=self._headers(api_key), json=payload)
+            response.raise_for_status()
+            return response.json()
+
+    async def stream_chat_completion(self, payload: dict, api_key: str):
+        """Yield content deltas from a streamed chat completion.
+
+        Closing the generator early (e.g. the caller was cancelled because the
+        client disconnected) closes the upstream response as well.
+        """
+        body = {**payload, "stream": True}
+        async with self.semaphore:
+            async with self.client.stream("POST", self.api_url, headers=self._headers(api_key), json=body) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    choices = json.loads(data).get("choices") or []
+                    if not choices:
+                        continue
+                    delta = choices[0].get("delta", {}).get("content")
+                    if delta:
+                        yield delta
+
+    async def aclose(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
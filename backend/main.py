@@ -1,7 +1,8 @@
-from fastapi import FastAPI, HTTPException, Depends, Header, File, UploadFile
+from fastapi import FastAPI, HTTPException, Depends, Header, File, UploadFile, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.security import HTTPBearer
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, confloat
 from typing import Optional, List
 import firebase_admin
 from firebase_admin import credentials, firestore, auth
@@ -9,16 +10,34 @@ import random
 import string
 import datetime
 import json
+import math
 import os
-import requests
-from typing import Dict, List
+import asyncio
+import httpx
+from typing import Dict, List, Tuple
 import uuid
 from dotenv import load_dotenv
 from fastapi import UploadFile
-import base64
-import PyPDF2
-from PIL import Image
+import csv
 import io
+from contextlib import aclosing
+from llm_client import LLMClient
+from data_access import (run_blocking, get_doc, get_docs, query_docs, count_docs, set_doc, update_doc, delete_doc,
+                         delete_refs, BATCH_LIMIT, BatchWriter,
+                         get_membership, remember_membership, forget_class_memberships,
+                         get_author_names, get_user_profiles, invalidate_user,
+                         get_class_context_info, remember_class, remember_class_post, forget_class)
+import data_access
+import auth_tokens
+import conversations
+import summary_cache
+import ingest
+import jobs
+import grades
+import search_index
+import cursors
+from prompt_builder import (PROMPT_TOKEN_BUDGET, COMPACTION_TARGET_RATIO, count_tokens, load_encoding,
+                            count_message_tokens, fit_history, group_by_tokens, split_tokens)
 
 # Load environment variables
 load_dotenv()
@@ -54,8 +73,61 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Firestore-Reads"],
 )
 
+class FirestoreReadCounterMiddleware:
+    """Report the Firestore documents read by each request in an X-Firestore-Reads header"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        counter = data_access.track_reads()
+
+        async def send_with_reads(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", []).append((b"x-firestore-reads", str(counter.reads).encode()))
+            await send(message)
+
+        await self.app(scope, receive, send_with_reads)
+
+app.add_middleware(FirestoreReadCounterMiddleware)
+
+@app.on_event("startup")
+async def start_signing_key_refresh():
+    app.state.signing_key_refresh = asyncio.create_task(auth_tokens.refresh_signing_keys_forever())
+
+@app.on_event("shutdown")
+async def stop_signing_key_refresh():
+    app.state.signing_key_refresh.cancel()
+
+@app.on_event("startup")
+async def load_token_encoding():
+    # May fetch the BPE file; never let that happen on the event loop
+    await run_blocking(load_encoding)
+
+@app.on_event("startup")
+async def start_job_workers():
+    await jobs.queue.start()
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    await jobs.queue.stop()
+
+# Registered after the job workers so they stop before the pools they use
+@app.on_event("shutdown")
+async def shutdown_data_access():
+    data_access.shutdown()
+
+@app.on_event("shutdown")
+async def shutdown_ingest_pool():
+    ingest.pool.shutdown()
+
 # Reserved for future auth middleware
 # security = HTTPBearer()
 
@@ -131,6 +203,7 @@ class AIStudyRequest(BaseModel):
     message: str
     conversation_id: Optional[str] = None
     class_context: Optional[str] = None  # Can include class name, recent posts, etc.
+    stream: bool = False  # Relay tokens as server-sent events
 
 class AIStudyResponse(BaseModel):
     response: str
@@ -155,6 +228,9 @@ class AIStudyWithFilesRequest(BaseModel):
 class NoteSummaryRequest(BaseModel):
     title: Optional[str] = None
     class_id: Optional[str] = None
+    first_page: Optional[int] = None  # 1-based, inclusive page range for PDFs
+    last_page: Optional[int] = None
+    long_document: bool = False  # Summarise the whole text map-reduce style instead of the first few pages
 
 class NoteSummary(BaseModel):
     summary_id: str
@@ -170,9 +246,14 @@ class NoteSummary(BaseModel):
     class_id: Optional[str] = None
     user_id: str
 
+class FileError(BaseModel):
+    filename: str
+    error: str
+
 class SummaryResponse(BaseModel):
     summary: NoteSummary
     raw_content_preview: str  # First 200 chars of original content
+    file_errors: List[FileError] = []  # Files that could not be read; the rest were still summarised
     
 # -------------------------------
 # Auth Dependencies
@@ -184,7 +265,7 @@ async def get_current_user(authorization: Optional[str] = Header(None)):
     
     token = authorization.split('Bearer ')[1]
     try:
-        decoded_token = auth.verify_id_token(token)
+        decoded_token = await auth_tokens.verify_id_token(token)
         return decoded_token
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Invalid authentication token: {str(e)}")
@@ -201,6 +282,9 @@ async def mock_get_current_user():
 # -------------------------------
 # Utility Functions
 # -------------------------------
+# New codes colliding this many times in a row means the code space needs widening
+CLASS_CODE_MAX_ATTEMPTS = 5
+
 def generate_class_code(length: int = 6) -> str:
     """Generate a class join code like 'ABC123'"""
     return "".join(random.choices(string.ascii_uppercase + string.digits, k=length))
@@ -211,13 +295,20 @@ def serialize_datetime(obj):
         return obj.isoformat()
     return obj
 
-def get_ai_response(conversation_history: List[Dict], api_key: str, class_context: str = None) -> str:
-    """Get AI response from OpenAI API with classroom context"""
-    
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
+def encode_cursor(created_at: datetime.datetime, doc_id: str) -> str:
+    """Build an opaque page cursor from the last item's (createdAt, doc id)"""
+    return cursors.encode({"t": created_at.isoformat(), "id": doc_id})
+
+def decode_cursor(cursor: str):
+    """Inverse of encode_cursor; returns (createdAt, doc id)"""
+    try:
+        payload = cursors.decode(cursor)
+        return datetime.datetime.fromisoformat(payload["t"]), payload["id"]
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def build_chat_payload(conversation_history: List[Dict], class_context: str = None) -> dict:
+    """Build the chat completion request body with classroom context"""
     
     # Enhance system prompt with class context if available
     system_message = conversation_history[0].copy()
@@ -233,53 +324,44 @@ def get_ai_response(conversation_history: List[Dict], api_key: str, class_contex
         "max_tokens": 300,
         "temperature": 0.7
     }
+    return data
+
+async def get_ai_response(conversation_history: List[Dict], api_key: str, class_context: str = None) -> str:
+    """Get AI response from OpenAI API with classroom context"""
+    data = build_chat_payload(conversation_history, class_context)
     
     try:
-        response = requests.post(OPENAI_API_URL, headers=headers, json=data)
-        response.raise_for_status()
-        result = response.json()
+        result = await llm_client.chat_completion(data, api_key)
         return result["choices"][0]["message"]["content"]
-    except requests.exceptions.RequestException as e:
+    except httpx.TimeoutException as e:
+        raise HTTPException(status_code=504, detail=f"AI service timed out: {str(e)}")
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"AI service error: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI processing error: {str(e)}")
 
-def get_class_context(class_id: str, db) -> str:
-    """Get recent class context for AI conversations"""
+async def get_class_context(class_id: str, db) -> str:
+    """Get recent class context for AI conversations (cached per class, see data_access)"""
+    if not class_id:
+        return ""
     try:
-        # Get class info
-        class_doc = db.collection("classes").document(class_id).get()
-        if not class_doc.exists:
+        info = await get_class_context_info(db, class_id)
+        if info is None:
             return ""
         
-        class_data = class_doc.to_dict()
-        class_name = class_data.get("name", "")
-        
-        # Get recent posts for context (last 3 posts)
-        recent_posts = (db.collection("classes").document(class_id)
-                       .collection("posts")
-                       .order_by("createdAt", direction=firestore.Query.DESCENDING)
-                       .limit(3)
-                       .stream())
-        
-        context = f"Class: {class_name}\n"
+        context = f"Class: {info['name']}\n"
         context += "Recent discussion topics:\n"
         
-        for post in recent_posts:
-            post_data = post.to_dict()
-            context += f"- {post_data.get('title', 'Untitled')}: {post_data.get('post_type', 'discussion')}\n"
+        for post in info["recent_posts"]:
+            context += f"- {post['title']}: {post['post_type']}\n"
         
         return context
     except Exception:
         return ""
     
-def get_ai_response_with_files(conversation_history: List[Dict], api_key: str, 
-                               files_content: List[Dict] = None, class_context: str = None) -> str:
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    
+def build_chat_with_files_payload(conversation_history: List[Dict], files_content: List[Dict] = None,
+                                  class_context: str = None) -> dict:
+    """Build the chat completion request body with uploaded file content"""
     # Enhance system prompt for file analysis
     system_message = conversation_history[0].copy()
     if files_content:
@@ -292,10 +374,11 @@ def get_ai_response_with_files(conversation_history: List[Dict], api_key: str,
     
     # Add file content to the last user message if files were provided
     if files_content and enhanced_history:
-        last_message = enhanced_history[-1]
+        # Copy so the stored conversation history keeps the plain text message
+        last_message = enhanced_history[-1] = enhanced_history[-1].copy()
         if last_message.get("role") == "user":
             # For OpenAI GPT-4 Vision API
-            if any(f["type"] == "image" for f in files_content):
+            if any(f["type"] == "image_url" for f in files_content):
                 last_message["content"] = [
                     {"type": "text", "text": last_message["content"]}
                 ] + files_content
@@ -305,76 +388,344 @@ def get_ai_response_with_files(conversation_history: List[Dict], api_key: str,
                 last_message["content"] += f"\n\nFile content:\n{text_content}"
     
     data = {
-        "model": "gpt-4-vision-preview" if any(f.get("type") == "image" for f in files_content or []) else "gpt-3.5-turbo",
+        "model": "gpt-4-vision-preview" if any(f.get("type") == "image_url" for f in files_content or []) else "gpt-3.5-turbo",
         "messages": enhanced_history,
         "max_tokens": 500,
         "temperature": 0.7
     }
+    return data
+
+async def get_ai_response_with_files(conversation_history: List[Dict], api_key: str, 
+                                     files_content: List[Dict] = None, class_context: str = None) -> str:
+    data = build_chat_with_files_payload(conversation_history, files_content, class_context)
     
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=data)
-    response.raise_for_status()
-    result = response.json()
-    return result["choices"][0]["message"]["content"]
-
-# File processing functions
-def extract_pdf_text(pdf_file: UploadFile) -> str:
-    pdf_reader = PyPDF2.PdfReader(pdf_file.file)
-    text = ""
-    for page in pdf_reader.pages:
-        text += page.extract_text() + "\n"
-    return text
-
-def process_image(image_file: UploadFile) -> str:
-    image_bytes = image_file.file.read()
-    base64_image = base64.b64encode(image_bytes).decode('utf-8')
-    return f"data:image/{image_file.filename.split('.')[-1]};base64,{base64_image}"    
-
-def get_structured_summary(file_content: str, api_key: str, user_title: str = None) -> dict:
-    """Get structured JSON summary from OpenAI"""
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
+    try:
+        result = await llm_client.chat_completion(data, api_key)
+        return result["choices"][0]["message"]["content"]
+    except httpx.TimeoutException as e:
+        raise HTTPException(status_code=504, detail=f"AI service timed out: {str(e)}")
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=500, detail=f"AI service error: {str(e)}")
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    """Format a server-sent event frame"""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data)}\n\n"
+
+def stream_ai_response(payload: dict, api_key: str, conversation_id: str, on_complete) -> StreamingResponse:
+    """Relay completion tokens as server-sent events.
+
+    Events: `start` (conversation id), unnamed `{"delta": ...}` frames, then
+    `done` once `on_complete(full_text)` has persisted the answer, or `error`.
+    An error's `stage` is `model` if the reply failed, or `save` if the full
+    reply (included as `response`) could not be persisted.
+    If the client disconnects, Starlette cancels this generator, which closes
+    the upstream OpenAI stream and skips persistence.
+    """
+    async def event_stream():
+        yield sse_event({"conversation_id": conversation_id}, event="start")
+        chunks = []
+        try:
+            async with aclosing(llm_client.stream_chat_completion(payload, api_key)) as deltas:
+                async for delta in deltas:
+                    chunks.append(delta)
+                    yield sse_event({"delta": delta})
+        except httpx.TimeoutException as e:
+            yield sse_event({"detail": f"AI service timed out: {str(e)}", "stage": "model"}, event="error")
+            return
+        except httpx.HTTPError as e:
+            yield sse_event({"detail": f"AI service error: {str(e)}", "stage": "model"}, event="error")
+            return
+        except Exception as e:
+            # e.g. a malformed upstream chunk; never end the stream without a terminal event
+            yield sse_event({"detail": f"AI service error: {str(e)}", "stage": "model"}, event="error")
+            return
+
+        ai_response = "".join(chunks)
+        try:
+            await on_complete(ai_response)
+        except Exception as e:
+            yield sse_event({"detail": f"Failed to save conversation: {str(e)}", "stage": "save",
+                             "response": ai_response}, event="error")
+            return
+        yield sse_event({
+            "conversation_id": conversation_id,
+            "response": ai_response,
+            "timestamp": datetime.datetime.utcnow().isoformat()
+        }, event="done")
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def build_prompt_history(summary: str, recent_messages: List[Dict], user_message: str) -> List[Dict]:
+    """System prompt (with the running summary) + recent turns + the new user message"""
+    system_prompt = STUDY_BUDDY_SYSTEM_PROMPT
+    if summary:
+        system_prompt += f"\n\nSummary of the conversation so far: {summary}"
+    return ([{"role": "system", "content": system_prompt}]
+            + [{"role": m.get("role"), "content": m.get("content")} for m in recent_messages]
+            + [{"role": "user", "content": user_message}])
+
+async def summarize_turns(previous_summary: str, messages: List[Dict], api_key: str) -> str:
+    """Fold evicted turns into the running conversation summary"""
+    transcript = "\n".join(f"{m.get('role')}: {m.get('content')}" for m in messages)
+    data = {
+        "model": "gpt-3.5-turbo",
+        "messages": [
+            {"role": "system", "content": CONVERSATION_SUMMARY_PROMPT},
+            {"role": "user", "content": f"Current summary:\n{previous_summary or '(none)'}\n\nNew turns:\n{transcript}"}
+        ],
+        "max_tokens": CONVERSATION_SUMMARY_MAX_TOKENS,
+        "temperature": 0.3
     }
-    
-    user_message = f"Analyze and summarize this content:\n\n{file_content[:3000]}"  # Limit content length
-    if user_title:
-        user_message = f"Title: {user_title}\n\n{user_message}"
+    result = await llm_client.chat_completion(data, api_key)
+    return result["choices"][0]["message"]["content"].strip()
+
+async def prepare_prompt_history(conv_ref, header: Optional[dict], recent_messages: List[Dict], user_message: str,
+                                 class_context: str, api_key: str, reserved_tokens: int = 0) -> List[Dict]:
+    """Fit the prompt into PROMPT_TOKEN_BUDGET, compacting older turns into the running summary.
+
+    `reserved_tokens` covers content added to the prompt later, e.g. file text.
+    """
+    summary = (header or {}).get("summary", "")
+    summarized_until = (header or {}).get("summarized_until", 0)
+    pending = conversations.unsummarized_messages(header, recent_messages)
+
+    def history_budget(summary: str) -> int:
+        fixed = build_prompt_history(summary, [], user_message)
+        if class_context:
+            fixed[0]["content"] += f"\n\nClass Context: {class_context}"
+        return PROMPT_TOKEN_BUDGET - reserved_tokens - count_message_tokens(fixed)
+
+    budget = history_budget(summary)
+    evicted, kept = fit_history(pending, budget)
+    if evicted or len(pending) >= conversations.HISTORY_WINDOW:
+        if pending and pending[0].get("seq", 0) > summarized_until:
+            # The load window starts after turns that were never summarised
+            # (legacy conversation or earlier failed compaction): fold those in too
+            pending = await conversations.load_unsummarized(conv_ref, header)
+        # Compact well below the budget so the next few turns fit without another summary call
+        evicted, kept = fit_history(pending, int(budget * COMPACTION_TARGET_RATIO))
+        overflow = len(kept) - conversations.HISTORY_WINDOW // 2
+        if overflow > 0:
+            evicted, kept = evicted + kept[:overflow], kept[overflow:]
+        folded_until = None
+        try:
+            for group in group_by_tokens(evicted, CONVERSATION_SUMMARY_INPUT_TOKENS):
+                summary = await summarize_turns(summary, group, api_key)
+                folded_until = group[-1]["seq"] + 1
+        except Exception as e:
+            # Still answer; turns not yet folded in stay unsummarised and are retried next turn
+            print(f"⚠️ Conversation compaction failed: {e}")
+        if folded_until is not None:
+            try:
+                await conversations.save_summary(db, conv_ref, summary, folded_until)
+            except Exception as e:
+                print(f"⚠️ Saving conversation summary failed: {e}")
+        _, kept = fit_history(kept, history_budget(summary))
+
+    return build_prompt_history(summary, kept, user_message)
+
+# File processing functions (CPU-bound work runs in the ingest process pool)
+async def run_ingest(fn, *args):
+    try:
+        return await ingest.pool.run(fn, *args)
+    except ingest.IngestBusy:
+        raise HTTPException(status_code=503, detail="File processing is at capacity, please retry shortly")
+    except ingest.IngestTimeout:
+        raise HTTPException(status_code=504, detail="File processing timed out")
+
+async def read_uploads(files: List[UploadFile]) -> List[Tuple[str, bytes]]:
+    """(filename, bytes) pairs, the form ingest tasks and queued jobs take"""
+    return [(file.filename, await file.read()) for file in files]
+
+async def extract_pdf_text(data: bytes, max_chars: Optional[int] = None, max_tokens: Optional[int] = None,
+                           first_page: int = 1, last_page: Optional[int] = None) -> str:
+    return await run_ingest(ingest.pdf_text, data, max_chars, max_tokens, first_page, last_page)
+
+async def process_image(filename: str, data: bytes) -> str:
+    try:
+        return await run_ingest(ingest.normalize_image, data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"{filename}: {str(e)}")
+
+async def process_files(uploads: List[Tuple[str, bytes]], process) -> Tuple[list, List[Dict]]:
+    """Run `await process(filename, data)` for every upload, at most FILE_INGEST_CONCURRENCY at a time.
+
+    Returns (results in upload order, per-file errors); a file that fails has
+    no entry in the results and does not fail the others. Server-side 5xx
+    failures such as a saturated ingest pool (503) or a timeout (504) are not
+    the file's fault: once every file has finished, the first one is raised so
+    clients and the job queue retry.
+    """
+    semaphore = asyncio.Semaphore(FILE_INGEST_CONCURRENCY)
+
+    async def run(filename: str, data: bytes):
+        async with semaphore:
+            try:
+                return await process(filename, data), None
+            except HTTPException as e:
+                if e.status_code >= 500:
+                    return e, None
+                return None, {"filename": filename, "error": str(e.detail)}
+            except Exception as e:
+                return None, {"filename": filename, "error": str(e)}
+
+    outcomes = await asyncio.gather(*(run(filename, data) for filename, data in uploads))
+    transient = [result for result, _ in outcomes if isinstance(result, HTTPException)]
+    if transient:
+        raise transient[0]
+    return ([result for result, error in outcomes if error is None],
+            [error for _, error in outcomes if error is not None])
+
+async def get_json_completion(system_prompt: str, user_message: str, api_key: str, max_tokens: int,
+                              cache_key: Optional[str]) -> dict:
+    """Ask OpenAI for a JSON object, reusing a cached result for the same cache_key
+    (None skips the cache). Cache errors are logged and treated as misses; they
+    never fail the request.
+    """
+    cached = None
+    if cache_key is not None:
+        try:
+            cached = await summary_cache.get(db, cache_key)
+        except Exception as e:
+            print(f"⚠️ Summary cache read failed: {e}")
+    if cached is not None:
+        return cached
     
     data = {
         "model": "gpt-3.5-turbo",
         "messages": [
-            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+            {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_message}
         ],
-        "max_tokens": 800,
+        "max_tokens": max_tokens,
         "temperature": 0.3  # Lower temperature for more consistent JSON
     }
     
     try:
-        response = requests.post(OPENAI_API_URL, headers=headers, json=data)
-        response.raise_for_status()
-        result = response.json()
+        result = await llm_client.chat_completion(data, api_key)
         
         ai_response = result["choices"][0]["message"]["content"].strip()
         
         # Parse JSON response
         try:
             summary_data = json.loads(ai_response)
-            return summary_data
         except json.JSONDecodeError as e:
             # Fallback: try to extract JSON from response if AI added extra text
             import re
             json_match = re.search(r'\{.*\}', ai_response, re.DOTALL)
             if json_match:
-                return json.loads(json_match.group())
+                summary_data = json.loads(json_match.group())
             else:
                 raise HTTPException(status_code=500, detail=f"AI returned invalid JSON: {str(e)}")
+        
+        if cache_key is not None:
+            try:
+                await summary_cache.put(db, cache_key, summary_data)
+            except Exception as e:
+                print(f"⚠️ Summary cache write failed: {e}")
+        return summary_data
                 
-    except requests.exceptions.RequestException as e:
+    except HTTPException:
+        raise
+    except httpx.TimeoutException as e:
+        raise HTTPException(status_code=504, detail=f"AI service timed out: {str(e)}")
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"AI service error: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Summary processing error: {str(e)}")
 
+async def get_structured_summary(file_content: str, api_key: str, user_title: str = None,
+                                 cache_content: Optional[str] = None) -> dict:
+    """Get structured JSON summary from OpenAI.
+    The result is cached by `cache_content` (default: the content itself); pass
+    the text without per-file headers so the same notes under another file
+    name share the cached summary.
+    """
+    prompt_content = file_content[:SUMMARY_CONTENT_CHARS]  # Limit content length
+    user_message = f"Analyze and summarize this content:\n\n{prompt_content}"
+    if user_title:
+        user_message = f"Title: {user_title}\n\n{user_message}"
+    
+    key_content = prompt_content if cache_content is None else cache_content[:SUMMARY_CONTENT_CHARS]
+    # With no extracted text (e.g. only images) the key would be the title alone,
+    # shared by unrelated uploads, so don't cache at all
+    cache_key = (summary_cache.cache_key(key_content, user_title, SUMMARY_PROMPT_VERSION)
+                 if key_content.strip() else None)
+    return await get_json_completion(SUMMARY_SYSTEM_PROMPT, user_message, api_key, 800, cache_key)
+
+async def get_map_reduce_summary(file_content: str, api_key: str, user_title: str = None, on_progress=None) -> dict:
+    """Structured summary of a long document.
+
+    The text is split into SUMMARY_CHUNK_TOKENS chunks that are summarised
+    concurrently (at most SUMMARY_MAP_CONCURRENCY at a time), then the partial
+    summaries are merged into the NoteSummary schema. When the partials don't
+    fit in one SUMMARY_REDUCE_INPUT_TOKENS prompt, they are first merged in
+    groups, level by level. At most LONG_DOCUMENT_MAX_TOKENS of text is used.
+    Chunk and merge results are cached, so a retry only redoes what failed. `await on_progress(done, total)`
+    runs after each chunk; if it raises (e.g. the job was cancelled), chunks
+    not yet started are skipped and the exception propagates.
+    """
+    chunks = split_tokens(file_content, SUMMARY_CHUNK_TOKENS)
+    chunks = chunks[:max(1, LONG_DOCUMENT_MAX_TOKENS // SUMMARY_CHUNK_TOKENS)]
+    semaphore = asyncio.Semaphore(SUMMARY_MAP_CONCURRENCY)
+    done = 0
+    stopped = None
+    
+    async def summarize_chunk(index: int, chunk: str) -> dict:
+        nonlocal done, stopped
+        async with semaphore:
+            if stopped is not None:
+                return None
+            user_message = f"Section {index + 1} of {len(chunks)}:\n\n{chunk}"
+            if user_title:
+                user_message = f"Document title: {user_title}\n\n{user_message}"
+            cache_key = summary_cache.cache_key(chunk, user_title, f"{SUMMARY_PROMPT_VERSION}-chunk")
+            partial = await get_json_completion(CHUNK_SUMMARY_PROMPT, user_message, api_key, 500, cache_key)
+        done += 1
+        if on_progress is not None:
+            try:
+                await on_progress(done, len(chunks))
+            except Exception as e:
+                stopped = e
+                raise
+        return partial
+    
+    results = await asyncio.gather(*(summarize_chunk(i, chunk) for i, chunk in enumerate(chunks)),
+                                   return_exceptions=True)
+    if stopped is not None:
+        raise stopped
+    failures = [r for r in results if isinstance(r, BaseException)]
+    if failures:
+        detail = failures[0].detail if isinstance(failures[0], HTTPException) else str(failures[0])
+        raise HTTPException(status_code=502, detail=f"{len(failures)} of {len(chunks)} sections failed to summarise: {detail}")
+    
+    async def merge_group(group: List[dict]) -> dict:
+        partials = json.dumps(group)
+        user_message = f"These are summaries of consecutive sections of one document. Merge them into one section summary covering all of them:\n\n{partials}"
+        cache_key = summary_cache.cache_key(partials, user_title, f"{SUMMARY_PROMPT_VERSION}-merge")
+        async with semaphore:
+            return await get_json_completion(CHUNK_SUMMARY_PROMPT, user_message, api_key, 500, cache_key)
+    
+    # Merge level by level until every partial fits in one reduce prompt
+    while True:
+        groups = group_by_tokens(results, SUMMARY_REDUCE_INPUT_TOKENS, cost=lambda p: count_tokens(json.dumps(p)))
+        # Stop too if no group holds two partials, since merging could not shrink the list
+        if len(groups) == 1 or len(groups) == len(results):
+            break
+        results = await asyncio.gather(*(merge_group(group) for group in groups))
+    
+    partials = json.dumps(results)
+    user_message = f"These are summaries of consecutive sections of one document. Merge them into a single summary of the whole document:\n\n{partials}"
+    if user_title:
+        user_message = f"Title: {user_title}\n\n{user_message}"
+    cache_key = summary_cache.cache_key(partials, user_title, f"{SUMMARY_PROMPT_VERSION}-reduce")
+    return await get_json_completion(SUMMARY_SYSTEM_PROMPT, user_message, api_key, 800, cache_key)
+
 
 
 # -------------------------------
@@ -385,7 +736,8 @@ async def signup(request: SignupRequest):
     """Register new user account"""
     try:
         # Create Firebase user
-        user_record = auth.create_user(
+        user_record = await run_blocking(
+            auth.create_user,
             email=request.email,
             password=request.password,
             display_name=request.full_name
@@ -401,10 +753,10 @@ async def signup(request: SignupRequest):
             "created_at": datetime.datetime.utcnow(),
             "karma": 0
         }
-        db.collection("users").document(user_record.uid).set(user_data)
+        await set_doc(db.collection("users").document(user_record.uid), user_data)
         
         # Generate custom token for immediate login
-        custom_token = auth.create_custom_token(user_record.uid)
+        custom_token = await run_blocking(auth.create_custom_token, user_record.uid)
         
         return AuthResponse(
             user_id=user_record.uid,
@@ -424,11 +776,13 @@ async def login(request: LoginRequest):
     try:
         # In a real implementation, you'd verify credentials via Firebase Auth REST API
         # or handle this entirely on the frontend
-        user = auth.get_user_by_email(request.email)
-        custom_token = auth.create_custom_token(user.uid)
+        user = await run_blocking(auth.get_user_by_email, request.email)
         
-        # Get user profile
-        user_doc = db.collection("users").document(user.uid).get()
+        # Mint token and get user profile concurrently
+        custom_token, user_doc = await asyncio.gather(
+            run_blocking(auth.create_custom_token, user.uid),
+            get_doc(db.collection("users").document(user.uid))
+        )
         user_data = user_doc.to_dict() if user_doc.exists else {}
         
         return {
@@ -444,11 +798,11 @@ async def login(request: LoginRequest):
 async def google_auth(request: GoogleAuthRequest):
     """Google OAuth authentication"""
     try:
-        decoded_token = auth.verify_id_token(request.id_token)
+        decoded_token = await auth_tokens.verify_id_token(request.id_token)
         uid = decoded_token['uid']
         
         # Check if user exists, create if not
-        user_doc = db.collection("users").document(uid).get()
+        user_doc = await get_doc(db.collection("users").document(uid))
         if not user_doc.exists:
             user_data = {
                 "email": decoded_token.get('email', ''),
@@ -457,7 +811,7 @@ async def google_auth(request: GoogleAuthRequest):
                 "created_at": datetime.datetime.utcnow(),
                 "karma": 0
             }
-            db.collection("users").document(uid).set(user_data)
+            await set_doc(db.collection("users").document(uid), user_data)
         else:
             user_data = user_doc.to_dict()
         
@@ -476,7 +830,8 @@ async def signout(current_user: dict = Depends(mock_get_current_user)):
     # In Firebase, sign out is typically handled on the frontend
     # Backend can revoke tokens if needed
     try:
-        auth.revoke_refresh_tokens(current_user['uid'])
+        await run_blocking(auth.revoke_refresh_tokens, current_user['uid'])
+        auth_tokens.forget_user_tokens(current_user['uid'])
         return {"message": "Successfully signed out"}
     except Exception as e:
         return {"message": "Signed out (token revocation failed)"}
@@ -494,7 +849,7 @@ async def get_me(email: Optional[str] = None, current_user: dict = Depends(mock_
     try:
         if email:
             # First, try Firestore by email
-            users_q = list(db.collection("users").where("email", "==", email).limit(1).stream())
+            users_q = await query_docs(db.collection("users").where("email", "==", email).limit(1))
             if users_q:
                 doc = users_q[0]
                 data = doc.to_dict()
@@ -509,15 +864,15 @@ async def get_me(email: Optional[str] = None, current_user: dict = Depends(mock_
 
             # Not found in Firestore → try Firebase Auth and upsert
             try:
-                user_record = auth.get_user_by_email(email)
+                user_record = await run_blocking(auth.get_user_by_email, email)
                 uid = user_record.uid
             except Exception:
                 raise HTTPException(status_code=404, detail="User not found")
 
             user_doc_ref = db.collection("users").document(uid)
-            user_doc = user_doc_ref.get()
+            user_doc = await get_doc(user_doc_ref)
             if not user_doc.exists:
-                user_doc_ref.set({
+                await set_doc(user_doc_ref, {
                     "email": email,
                     "full_name": getattr(user_record, 'display_name', "") or "",
                     "university": None,
@@ -526,7 +881,7 @@ async def get_me(email: Optional[str] = None, current_user: dict = Depends(mock_
                     "created_at": datetime.datetime.utcnow(),
                     "karma": 0,
                 })
-                data = user_doc_ref.get().to_dict()
+                data = (await get_doc(user_doc_ref)).to_dict()
             else:
                 data = user_doc.to_dict()
 
@@ -541,7 +896,7 @@ async def get_me(email: Optional[str] = None, current_user: dict = Depends(mock_
 
         # No email param: use current_user
         uid = current_user.get('uid')
-        user_doc = db.collection("users").document(uid).get()
+        user_doc = await get_doc(db.collection("users").document(uid))
         if not user_doc.exists:
             raise HTTPException(status_code=404, detail="User profile not found")
         data = user_doc.to_dict()
@@ -568,17 +923,18 @@ async def update_me(payload: ProfileUpdateRequest, email: Optional[str] = None,
 
         if email:
             try:
-                user_record = auth.get_user_by_email(email)
+                user_record = await run_blocking(auth.get_user_by_email, email)
                 uid = user_record.uid
             except Exception:
                 raise HTTPException(status_code=404, detail="User not found")
-            db.collection("users").document(uid).set({
+            await set_doc(db.collection("users").document(uid), {
                 "email": email,
                 **update_data
             }, merge=True)
         else:
             uid = current_user.get('uid')
-            db.collection("users").document(uid).set(update_data, merge=True)
+            await set_doc(db.collection("users").document(uid), update_data, merge=True)
+        invalidate_user(uid)
         return {"message": "Profile updated"}
     except HTTPException:
         raise
@@ -591,6 +947,14 @@ async def update_me(payload: ProfileUpdateRequest, email: Optional[str] = None,
 
 OPENAI_API_URL = "https://api.openai.com/v1/chat/completions"
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "your-openai-api-key-here")
+
+# Pooled async client shared by every OpenAI call (timeouts/limits via OPENAI_* env vars)
+llm_client = LLMClient.from_env(OPENAI_API_URL)
+
+@app.on_event("shutdown")
+async def close_llm_client():
+    await llm_client.aclose()
+
 STUDY_BUDDY_SYSTEM_PROMPT = """You are an AI Study Buddy for a classroom discussion platform. Your role is to help students learn by:
 
 1. Asking guiding questions instead of giving direct answers
@@ -607,6 +971,30 @@ When a student asks a question:
 
 Keep responses concise but helpful. Always aim to facilitate learning rather than just providing answers."""
 
+CONVERSATION_SUMMARY_PROMPT = """You maintain a running summary of a tutoring conversation between a student and an AI Study Buddy. You are given the current summary and the turns that follow it. Return an updated summary that keeps the topics covered, the student's questions and misunderstandings, and anything they said they would do next. Write in plain prose, under 150 words, with no preamble."""
+
+CONVERSATION_SUMMARY_MAX_TOKENS = 250
+# Turns sent per summary call; leaves room for the instructions, current summary and reply
+CONVERSATION_SUMMARY_INPUT_TOKENS = PROMPT_TOKEN_BUDGET - 2 * CONVERSATION_SUMMARY_MAX_TOKENS
+
+# Files from one upload processed at the same time
+FILE_INGEST_CONCURRENCY = int(os.getenv("FILE_INGEST_CONCURRENCY", "4"))
+
+# Characters of uploaded content sent with a chat turn / summary request
+CHAT_FILE_CONTENT_CHARS = 2000
+SUMMARY_CONTENT_CHARS = 3000
+
+# Long-document mode: text is extracted up to LONG_DOCUMENT_MAX_TOKENS and
+# summarised map-reduce style in SUMMARY_CHUNK_TOKENS chunks
+LONG_DOCUMENT_MAX_TOKENS = int(os.getenv("LONG_DOCUMENT_MAX_TOKENS", "60000"))
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "2000"))
+SUMMARY_MAP_CONCURRENCY = int(os.getenv("SUMMARY_MAP_CONCURRENCY", "4"))
+# Partial summaries per merge prompt; the rest of PROMPT_TOKEN_BUDGET covers the instructions
+SUMMARY_REDUCE_INPUT_TOKENS = int(os.getenv("SUMMARY_REDUCE_INPUT_TOKENS", str(PROMPT_TOKEN_BUDGET - 600)))
+
+# Bump whenever SUMMARY_SYSTEM_PROMPT or the summary request changes so cached results are not reused
+SUMMARY_PROMPT_VERSION = "1"
+
 SUMMARY_SYSTEM_PROMPT = """You are an AI that creates structured study summaries. When given document content, you must respond with ONLY a valid JSON object in this exact format:
 
 {
@@ -626,6 +1014,19 @@ Rules:
 - Make review questions thought-provoking
 - Base difficulty on content complexity
 - Estimate realistic study time"""
+
+CHUNK_SUMMARY_PROMPT = """You summarise one section of a longer document so the sections can later be merged into a single study summary. Respond with ONLY a valid JSON object in this exact format:
+
+{
+    "key_concepts": ["concept1", "concept2"],
+    "main_points": ["point1", "point2"],
+    "questions_for_review": ["question1?", "question2?"]
+}
+
+Rules:
+- Always return valid JSON only, no other text
+- Include 2-5 items in each array
+- Only use information from this section"""
 @app.post("/api/v1/ai-study-buddy", response_model=AIStudyResponse)
 async def chat_with_study_buddy(
     request: AIStudyRequest,
@@ -639,43 +1040,31 @@ async def chat_with_study_buddy(
         # Generate or use existing conversation ID
         conversation_id = request.conversation_id or str(uuid.uuid4())
         
-        # Get or create conversation history
-        conv_doc_ref = db.collection("ai_conversations").document(conversation_id)
-        conv_doc = conv_doc_ref.get()
-        
-        if conv_doc.exists:
-            conv_data = conv_doc.to_dict()
-            conversation_history = conv_data.get("messages", [])
-        else:
-            # Initialize new conversation with system prompt
-            conversation_history = [
-                {"role": "system", "content": STUDY_BUDDY_SYSTEM_PROMPT}
-            ]
+        # Get recent conversation history and class context (if provided) concurrently
+        conv_ref = db.collection("ai_conversations").document(conversation_id)
+        user_sent_at = datetime.datetime.utcnow()
+        (header, recent_messages), class_context = await asyncio.gather(
+            conversations.load_conversation(conv_ref),
+            get_class_context(request.class_context, db)
+        )
+        conversation_history = await prepare_prompt_history(
+            conv_ref, header, recent_messages, request.message, class_context, OPENAI_API_KEY
+        )
         
-        # Add user message to history
-        conversation_history.append({"role": "user", "content": request.message})
+        async def finish(ai_response: str):
+            # Append this turn to the conversation in Firestore
+            await conversations.append_messages(db, conv_ref, [
+                {"role": "user", "content": request.message, "created_at": user_sent_at},
+                {"role": "assistant", "content": ai_response}
+            ], class_id=request.class_context, user_id=current_user['uid'])
         
-        # Get class context if provided
-        class_context = ""
-        if request.class_context:
-            class_context = get_class_context(request.class_context, db)
+        if request.stream:
+            payload = build_chat_payload(conversation_history, class_context)
+            return stream_ai_response(payload, OPENAI_API_KEY, conversation_id, finish)
         
         # Get AI response
-        ai_response = get_ai_response(conversation_history, OPENAI_API_KEY, class_context)
-        
-        # Add AI response to history
-        conversation_history.append({"role": "assistant", "content": ai_response})
-        
-        # Save conversation to Firestore
-        conv_data = {
-            "conversation_id": conversation_id,
-            "messages": conversation_history,
-            "class_id": request.class_context,
-            "user_id": current_user['uid'],
-            "created_at": conv_doc.get("created_at") if conv_doc.exists else datetime.datetime.utcnow(),
-            "last_updated": datetime.datetime.utcnow()
-        }
-        conv_doc_ref.set(conv_data)
+        ai_response = await get_ai_response(conversation_history, OPENAI_API_KEY, class_context)
+        await finish(ai_response)
         
         return AIStudyResponse(
             response=ai_response,
@@ -694,28 +1083,23 @@ async def get_study_buddy_conversations(
 ):
     """Get user's AI study buddy conversation history"""
     try:
-        conversations = (db.collection("ai_conversations")
-                        .where("user_id", "==", current_user['uid'])
-                        .order_by("last_updated", direction=firestore.Query.DESCENDING)
-                        .limit(10)
-                        .stream())
+        conversation_docs = await query_docs(db.collection("ai_conversations")
+                                             .where("user_id", "==", current_user['uid'])
+                                             .order_by("last_updated", direction=firestore.Query.DESCENDING)
+                                             .limit(10))
         
         conversation_list = []
-        for conv in conversations:
+        for conv in conversation_docs:
             conv_data = conv.to_dict()
-            # Get the first user message as preview
-            first_message = ""
-            for msg in conv_data.get("messages", []):
-                if msg.get("role") == "user":
-                    first_message = msg.get("content", "")[:100] + "..."
-                    break
+            # Preview and count come from the header, not the messages themselves
+            header_summary = conversations.summarize_header(conv_data)
             
             conversation_list.append({
                 "conversation_id": conv_data.get("conversation_id"),
-                "preview": first_message,
+                "preview": header_summary["preview"],
                 "class_id": conv_data.get("class_id"),
                 "last_updated": serialize_datetime(conv_data.get("last_updated")),
-                "message_count": len([m for m in conv_data.get("messages", []) if m.get("role") != "system"])
+                "message_count": header_summary["message_count"]
             })
         
         return {"conversations": conversation_list}
@@ -730,7 +1114,8 @@ async def get_conversation_details(
 ):
     """Get specific AI study buddy conversation"""
     try:
-        conv_doc = db.collection("ai_conversations").document(conversation_id).get()
+        conv_ref = db.collection("ai_conversations").document(conversation_id)
+        conv_doc = await get_doc(conv_ref)
         if not conv_doc.exists:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
@@ -740,15 +1125,14 @@ async def get_conversation_details(
         if conv_data.get("user_id") != current_user['uid']:
             raise HTTPException(status_code=403, detail="Access denied")
         
-        # Format messages for response (exclude system message)
+        # Format messages for response; legacy inline messages have no own timestamp
         formatted_messages = []
-        for msg in conv_data.get("messages", []):
-            if msg.get("role") != "system":
-                formatted_messages.append({
-                    "role": msg.get("role"),
-                    "content": msg.get("content"),
-                    "timestamp": serialize_datetime(conv_data.get("last_updated"))
-                })
+        for msg in await conversations.get_all_messages(conv_ref, conv_data):
+            formatted_messages.append({
+                "role": msg.get("role"),
+                "content": msg.get("content"),
+                "timestamp": serialize_datetime(msg.get("created_at") or conv_data.get("last_updated"))
+            })
         
         return {
             "conversation_id": conversation_id,
@@ -772,8 +1156,8 @@ async def class_specific_study_buddy(
     """Chat with AI Study Buddy in context of specific class"""
     try:
         # Verify user is member of class
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        member = await get_membership(db, class_id, current_user['uid'])
+        if member is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
         
         # Set class context and call main study buddy endpoint
@@ -794,14 +1178,15 @@ async def get_ai_help_for_post(
 ):
     """Get AI study buddy help for a specific post"""
     try:
-        # Verify user is member of class
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        # Verify membership and get post content concurrently
+        member, post_doc = await asyncio.gather(
+            get_membership(db, class_id, current_user['uid']),
+            get_doc(db.collection("classes").document(class_id)
+                    .collection("posts").document(post_id))
+        )
+        if member is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
         
-        # Get post content
-        post_doc = (db.collection("classes").document(class_id)
-                   .collection("posts").document(post_id).get())
         if not post_doc.exists:
             raise HTTPException(status_code=404, detail="Post not found")
         
@@ -836,7 +1221,10 @@ class CreateAssignmentRequest(BaseModel):
 
 class SetGradeRequest(BaseModel):
     assignment_id: str
-    grade: float
+    # NaN/inf would poison the student's aggregate mean and break JSON responses
+    grade: confloat(allow_inf_nan=False)
+
+BULK_GRADE_MAX_ROWS = 5000
 
 
 @app.post("/api/v1/classes")
@@ -847,38 +1235,68 @@ async def create_class(request: CreateClassRequest, email: Optional[str] = None,
     try:
         # Resolve creator uid
         if email:
-            user_record = auth.get_user_by_email(email)
+            user_record = await run_blocking(auth.get_user_by_email, email)
             creator_uid = user_record.uid
         else:
             creator_uid = current_user.get('uid')
 
         class_ref = db.collection("classes").document()
         class_id = class_ref.id
-        code = generate_class_code()
-        class_doc = {
-            "name": request.name,
-            "code": code,
-            "createdBy": creator_uid,
-            "createdAt": datetime.datetime.utcnow(),
-            "joinMode": request.join_mode,
-            "visibility": request.visibility,
-        }
-        class_ref.set(class_doc)
+
+        # Claim classCodes/{code} and create the class in one transaction; retry on collision
+        def _create_with_code(class_doc: dict) -> bool:
+            code_ref = db.collection("classCodes").document(class_doc["code"])
+
+            @firestore.transactional
+            def create(transaction):
+                if code_ref.get(transaction=transaction).exists:
+                    return False
+                transaction.set(code_ref, {
+                    "classId": class_id,
+                    "className": class_doc["name"],
+                    "createdAt": class_doc["createdAt"],
+                })
+                transaction.set(class_ref, class_doc)
+                return True
+
+            return create(db.transaction())
+
+        for _ in range(CLASS_CODE_MAX_ATTEMPTS):
+            code = generate_class_code()
+            class_doc = {
+                "name": request.name,
+                "code": code,
+                "createdBy": creator_uid,
+                "createdAt": datetime.datetime.utcnow(),
+                "joinMode": request.join_mode,
+                "visibility": request.visibility,
+            }
+            if await run_blocking(_create_with_code, class_doc):
+                break
+        else:
+            raise HTTPException(status_code=503, detail="Could not allocate a unique class code, please retry")
+        remember_class(class_id, request.name)
 
         # Add creator as instructor member
         member_doc = {
             "classId": class_id,
             "userId": creator_uid,
             "role": "instructor",
-            "joinedAt": datetime.datetime.utcnow()
+            "joinedAt": datetime.datetime.utcnow(),
+            # Denormalised so "my classes" is a single query
+            "className": request.name,
+            "classCode": code
         }
-        db.collection("classMembers").document(f"{class_id}_{creator_uid}").set(member_doc)
+        await set_doc(db.collection("classMembers").document(f"{class_id}_{creator_uid}"), member_doc)
+        remember_membership(class_id, creator_uid, member_doc)
 
         return {
             "class_id": class_id,
             "name": request.name,
             "code": code,
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create class: {str(e)}")
 @app.get("/api/v1/classes")
@@ -888,7 +1306,7 @@ async def get_user_classes(email: Optional[str] = None, current_user: dict = Dep
         # Resolve uid from email if provided (dev convenience), else use current user
         if email:
             try:
-                user_record = auth.get_user_by_email(email)
+                user_record = await run_blocking(auth.get_user_by_email, email)
                 resolved_uid = user_record.uid
             except Exception:
                 raise HTTPException(status_code=404, detail="User not found")
@@ -896,24 +1314,34 @@ async def get_user_classes(email: Optional[str] = None, current_user: dict = Dep
             resolved_uid = current_user['uid']
 
         # Get user's class memberships
-        memberships = db.collection("classMembers").where("userId", "==", resolved_uid).stream()
+        memberships = [m.to_dict() for m in
+                       await query_docs(db.collection("classMembers").where("userId", "==", resolved_uid))]
+        
+        # Memberships carry className/classCode; only ones written before that
+        # (not yet backfilled) need their class fetched, in one batched read
+        legacy_ids = [m.get("classId") for m in memberships if "className" not in m or "classCode" not in m]
+        class_docs = await get_docs(db, [db.collection("classes").document(cid) for cid in legacy_ids])
         
         classes = []
-        for membership in memberships:
-            member_data = membership.to_dict()
+        for member_data in memberships:
             class_id = member_data.get("classId")
-            
-            # Get class details
-            class_doc = db.collection("classes").document(class_id).get()
-            if class_doc.exists:
+            if member_data.get("classDeleting"):
+                continue
+            if class_id in class_docs:
+                class_doc = class_docs[class_id]
+                if not class_doc.exists or class_doc.to_dict().get("deleting"):
+                    continue
                 class_data = class_doc.to_dict()
-                classes.append({
-                    "class_id": class_id,
-                    "name": class_data.get("name"),
-                    "code": class_data.get("code"),
-                    "role": member_data.get("role"),
-                    "joined_at": serialize_datetime(member_data.get("joinedAt"))
-                })
+                name, code = class_data.get("name"), class_data.get("code")
+            else:
+                name, code = member_data.get("className"), member_data.get("classCode")
+            classes.append({
+                "class_id": class_id,
+                "name": name,
+                "code": code,
+                "role": member_data.get("role"),
+                "joined_at": serialize_datetime(member_data.get("joinedAt"))
+            })
         
         return {"classes": classes}
     except Exception as e:
@@ -925,21 +1353,19 @@ async def join_class_by_code(request: JoinClassRequest, email: Optional[str] = N
     try:
         code = request.class_code.upper()
         
-        # Find class by code
-        classes_query = db.collection("classes").where("code", "==", code).limit(1)
-        classes = list(classes_query.stream())
+        # Find class by code through the classCodes index
+        code_doc = await get_doc(db.collection("classCodes").document(code))
         
-        if not classes:
+        if not code_doc.exists:
             raise HTTPException(status_code=404, detail="Invalid class code")
         
-        class_doc = classes[0]
-        class_id = class_doc.id
-        class_data = class_doc.to_dict()
+        code_data = code_doc.to_dict()
+        class_id = code_data["classId"]
         
         # Resolve user id
         if email:
             try:
-                user_record = auth.get_user_by_email(email)
+                user_record = await run_blocking(auth.get_user_by_email, email)
                 uid = user_record.uid
             except Exception:
                 raise HTTPException(status_code=404, detail="User not found")
@@ -947,8 +1373,7 @@ async def join_class_by_code(request: JoinClassRequest, email: Optional[str] = N
             uid = current_user['uid']
         
         # Check if already a member
-        member_doc = db.collection("classMembers").document(f"{class_id}_{uid}").get()
-        if member_doc.exists:
+        if await get_membership(db, class_id, uid) is not None:
             return {"message": "Already a member of this class", "class_id": class_id}
         
         # Add as student
@@ -956,14 +1381,18 @@ async def join_class_by_code(request: JoinClassRequest, email: Optional[str] = N
             "classId": class_id,
             "userId": uid,
             "role": "student",
-            "joinedAt": datetime.datetime.utcnow()
+            "joinedAt": datetime.datetime.utcnow(),
+            # Denormalised so "my classes" is a single query
+            "className": code_data.get("className"),
+            "classCode": code
         }
-        db.collection("classMembers").document(f"{class_id}_{uid}").set(member_data)
+        await set_doc(db.collection("classMembers").document(f"{class_id}_{uid}"), member_data)
+        remember_membership(class_id, uid, member_data)
         
         return {
             "message": "Successfully joined class",
             "class_id": class_id,
-            "class_name": class_data.get("name")
+            "class_name": code_data.get("className")
         }
     except HTTPException:
         raise
@@ -971,45 +1400,59 @@ async def join_class_by_code(request: JoinClassRequest, email: Optional[str] = N
         raise HTTPException(status_code=500, detail=f"Failed to join class: {str(e)}")
 
 @app.get("/api/v1/classes/{class_id}")
-async def get_class_details(class_id: str, limit: int = 20, offset: int = 0, 
+async def get_class_details(class_id: str, limit: int = 20, offset: int = 0, cursor: Optional[str] = None,
                            current_user: dict = Depends(get_current_user)):
-    """Get class details and posts"""
+    """Get class details and posts.
+    Page with ?cursor=<next_cursor from the previous page>. `offset` is deprecated
+    (Firestore still reads every skipped post) and only used when no cursor is given.
+    """
     try:
+        limit = max(1, min(limit, 100))
+        # Posts newest first; doc id breaks createdAt ties so cursors are stable
+        posts_ref = db.collection("classes").document(class_id).collection("posts")
+        posts_query = (posts_ref
+                      .order_by("createdAt", direction=firestore.Query.DESCENDING)
+                      .order_by(firestore.FieldPath.document_id(), direction=firestore.Query.DESCENDING))
+        if cursor:
+            cursor_created_at, cursor_id = decode_cursor(cursor)
+            posts_query = posts_query.start_after([cursor_created_at, posts_ref.document(cursor_id)])
+        elif offset:
+            posts_query = posts_query.offset(offset)
+        # Fetch one extra post to know whether another page exists
+        posts_query = posts_query.limit(limit + 1)
+        
+        # Membership check, class details and posts are independent reads
+        member, class_doc, post_docs = await asyncio.gather(
+            get_membership(db, class_id, current_user['uid']),
+            get_doc(db.collection("classes").document(class_id)),
+            query_docs(posts_query)
+        )
+        
         # Verify user is member of class
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        if member is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
         
-        # Get class details
-        class_doc = db.collection("classes").document(class_id).get()
-        if not class_doc.exists:
+        class_data = class_doc.to_dict() if class_doc.exists else None
+        if class_data is None or class_data.get("deleting"):
             raise HTTPException(status_code=404, detail="Class not found")
         
-        class_data = class_doc.to_dict()
+        has_more = len(post_docs) > limit
+        post_docs = post_docs[:limit]
         
-        # Get posts with pagination
-        posts_query = (db.collection("classes").document(class_id)
-                      .collection("posts")
-                      .order_by("createdAt", direction=firestore.Query.DESCENDING)
-                      .limit(limit)
-                      .offset(offset))
+        # Get author names for the page: deduplicated, cached, one batched read for misses
+        post_rows = [(post_doc.id, post_doc.to_dict()) for post_doc in post_docs]
+        author_names = await get_author_names(db, [post_data.get("authorId") for _, post_data in post_rows])
         
         posts = []
-        for post_doc in posts_query.stream():
-            post_data = post_doc.to_dict()
-            
-            # Get author info
-            author_doc = db.collection("users").document(post_data.get("authorId", "")).get()
-            author_data = author_doc.to_dict() if author_doc.exists else {}
-            
+        for post_id, post_data in post_rows:
             posts.append({
-                "post_id": post_doc.id,
+                "post_id": post_id,
                 "title": post_data.get("title", ""),
                 "content": post_data.get("content", ""),
                 "post_type": post_data.get("post_type", "discussion"),
                 "tags": post_data.get("tags", []),
                 "author_id": post_data.get("authorId"),
-                "author_name": author_data.get("full_name", "Unknown"),
+                "author_name": author_names.get(post_data.get("authorId"), "Unknown"),
                 "created_at": serialize_datetime(post_data.get("createdAt")),
                 "files": post_data.get("files", [])
             })
@@ -1028,7 +1471,8 @@ async def get_class_details(class_id: str, limit: int = 20, offset: int = 0,
             "pagination": {
                 "limit": limit,
                 "offset": offset,
-                "has_more": len(posts) == limit
+                "has_more": has_more,
+                "next_cursor": encode_cursor(post_rows[-1][1]["createdAt"], post_rows[-1][0]) if has_more else None
             }
         }
     except HTTPException:
@@ -1040,68 +1484,220 @@ async def get_class_details(class_id: str, limit: int = 20, offset: int = 0,
 async def delete_class(class_id: str, email: Optional[str] = None, current_user: dict = Depends(mock_get_current_user)):
     """Delete a class and related data (instructors only; creator can delete).
     In dev, allow ?email=... to resolve the actor via Firebase Auth.
+    Deletion runs as a background job: responds 202 with a job id to poll.
+    If a deletion was cancelled or failed, the creator can repeat the request.
     """
     try:
         # Resolve acting uid
         if email:
             try:
-                user_record = auth.get_user_by_email(email)
+                user_record = await run_blocking(auth.get_user_by_email, email)
                 uid = user_record.uid
             except Exception:
                 raise HTTPException(status_code=404, detail="User not found")
         else:
             uid = current_user.get('uid')
 
-        # Verify class exists
+        # Fetch class and caller membership concurrently
         class_ref = db.collection("classes").document(class_id)
-        class_doc = class_ref.get()
+        class_doc, member = await asyncio.gather(
+            get_doc(class_ref),
+            get_membership(db, class_id, uid)
+        )
+
+        # Verify class exists
         if not class_doc.exists:
             raise HTTPException(status_code=404, detail="Class not found")
         class_data = class_doc.to_dict()
 
-        # Verify user is instructor and creator
+        # Verify user is instructor and creator. A class already being deleted
+        # may have lost the creator's membership, so the creator alone suffices.
         creator_uid = class_data.get("createdBy")
-        member_doc = db.collection("classMembers").document(f"{class_id}_{uid}").get()
-        if not member_doc.exists or member_doc.to_dict().get("role") != "instructor" or uid != creator_uid:
+        is_instructor = member is not None and member.get("role") == "instructor"
+        if uid != creator_uid or not (is_instructor or class_data.get("deleting")):
             raise HTTPException(status_code=403, detail="Only the creating instructor can delete this class")
 
-        # Best-effort delete subcollections
-        def _delete_subcollection(parent_ref, sub_name):
-            try:
-                for doc in parent_ref.collection(sub_name).stream():
-                    doc.reference.delete()
-            except Exception:
-                pass
-
-        _delete_subcollection(class_ref, "posts")
-        _delete_subcollection(class_ref, "assignments")
-        _delete_subcollection(class_ref, "grades")
+        # Mark the class and delete its data in the background; repeating the
+        # request just queues another (idempotent) pass
+        await update_doc(class_ref, {"deleting": True})
+        job_id = await jobs.queue.submit("delete_class", {"class_id": class_id}, user_id=current_user.get('uid'))
+        forget_class_memberships(class_id)
+        forget_class(class_id)
+        search_index.forget(class_id)
+
+        return JSONResponse(status_code=202, content={
+            "message": "Class deletion started",
+            "job_id": job_id,
+            "status_url": f"/api/v1/jobs/{job_id}"
+        })
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to delete class: {str(e)}")
 
-        # Delete memberships for this class
-        try:
-            for m in db.collection("classMembers").where("classId", "==", class_id).stream():
-                m.reference.delete()
-        except Exception:
-            pass
+def class_data_queries(class_id: str) -> Dict[str, object]:
+    """Every query whose documents belong to a class and go when it is deleted.
+    Memberships come last: they are only removed once everything else is gone.
+    """
+    class_ref = db.collection("classes").document(class_id)
+    return {
+        "posts": class_ref.collection("posts"),
+        "assignments": class_ref.collection("assignments"),
+        "grades": class_ref.collection("grades"),
+        "grade_aggregates": class_ref.collection(grades.AGGREGATES_SUBCOLLECTION),
+        "memberships": db.collection("classMembers").where("classId", "==", class_id),
+    }
 
-        # Finally delete the class document
-        class_ref.delete()
+def _flag_memberships_deleting(member_refs: list):
+    writer = BatchWriter(db)
+    for ref in member_refs:
+        writer.update(ref, {"classDeleting": True})
+    writer.flush()
+
+def _delete_with_class(refs: list, class_ref):
+    batch = db.batch()
+    for ref in refs:
+        batch.delete(ref)
+    batch.delete(class_ref)
+    batch.commit()
+
+async def run_delete_class_job(job: jobs.Job) -> dict:
+    """Delete a class's data in batches.
+
+    Posts, assignments and grades are drained in parallel first. Memberships go
+    after them, and the last membership batch also deletes the class doc, so a
+    class whose deletion stops part-way still has its members. Each pass
+    deletes whatever is still there, so a resumed or repeated job simply
+    carries on; only the progress counters live in the job state.
+    """
+    class_id = job.payload["class_id"]
+    class_ref = db.collection("classes").document(class_id)
+    class_doc = await get_doc(class_ref)
+    if class_doc.exists:
+        # Release the join code first so nobody joins mid-deletion
+        code = class_doc.to_dict().get("code")
+        if code:
+            code_ref = db.collection("classCodes").document(code)
+            code_doc = await get_doc(code_ref)
+            if code_doc.exists and code_doc.to_dict().get("classId") == class_id:
+                await delete_doc(code_ref)
+
+    queries = class_data_queries(class_id)
+    memberships = queries["memberships"]
+    if "totals" not in job.state:
+        # Hide the class from members' class lists while it is being deleted
+        members = await query_docs(memberships.select([]))
+        await run_blocking(_flag_memberships_deleting, [m.reference for m in members])
+        counts = await asyncio.gather(*(count_docs(q) for q in queries.values()))
+        await job.report(0, totals=dict(zip(queries, counts)), deleted={name: 0 for name in queries})
+    totals = job.state["totals"]
+    deleted = job.state["deleted"]
+
+    async def report(name: str, count: int):
+        deleted[name] = deleted.get(name, 0) + count
+        total = max(sum(totals.values()), sum(deleted.values()), 1)
+        await job.report(sum(deleted.values()) / total, deleted=deleted)
+
+    async def drain(name: str, query):
+        while True:
+            docs = await query_docs(query.select([]).limit(BATCH_LIMIT))
+            if not docs:
+                return
+            await delete_refs(db, [d.reference for d in docs])
+            await report(name, len(docs))
+
+    await asyncio.gather(*(drain(name, query) for name, query in queries.items() if name != "memberships"))
+
+    # Leave room in the final batch for the class doc itself
+    while True:
+        docs = await query_docs(memberships.select([]).limit(BATCH_LIMIT - 1))
+        refs = [d.reference for d in docs]
+        if len(refs) < BATCH_LIMIT - 1:
+            await run_blocking(_delete_with_class, refs, class_ref)
+            await report("memberships", len(refs))
+            break
+        await delete_refs(db, refs)
+        await report("memberships", len(refs))
+
+    forget_class_memberships(class_id)
+    forget_class(class_id)
+    search_index.forget(class_id)
+    return {"class_id": class_id, "deleted": deleted}
+
+jobs.queue.register("delete_class", run_delete_class_job)
+
+@app.get("/api/v1/classes/{class_id}/posts/search")
+async def search_posts(class_id: str, q: str = Query(..., min_length=1, max_length=200), limit: int = 20,
+                       cursor: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    """Full-text search over a class's posts, best match first.
+    Page with ?cursor=<next_cursor from the previous page> and the same `q`.
+    """
+    try:
+        limit = max(1, min(limit, 50))
+        terms = search_index.tokenize(q)
+        if not terms:
+            raise HTTPException(status_code=400, detail="Query has no searchable words")
+        offset = 0
+        if cursor:
+            try:
+                offset = search_index.decode_cursor(terms, cursor)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
 
-        return {"message": "Class deleted"}
+        # Checked first so non-members can't make this instance build a class's index
+        member = await get_membership(db, class_id, current_user['uid'])
+        if member is None:
+            raise HTTPException(status_code=403, detail="Not a member of this class")
+        index = await search_index.get_index(db, class_id)
+
+        # One extra hit to know whether another page exists
+        ranked = index.search(terms, offset + limit + 1)
+        has_more = len(ranked) > offset + limit
+        hits = [(score, post_id, index.posts[post_id]) for score, post_id in ranked[offset:offset + limit]]
+        author_names = await get_author_names(db, [post.get("authorId") for _, _, post in hits])
+
+        results = [
+            {
+                "post_id": post_id,
+                "title": post.get("title", ""),
+                "snippet": search_index.snippet(post.get("content") or "", terms),
+                "score": round(score, 4),
+                "post_type": post.get("post_type", "discussion"),
+                "tags": post.get("tags", []),
+                "author_id": post.get("authorId"),
+                "author_name": author_names.get(post.get("authorId"), "Unknown"),
+                "created_at": serialize_datetime(post.get("createdAt")),
+            }
+            for score, post_id, post in hits
+        ]
+        return {
+            "query": q,
+            "results": results,
+            "pagination": {
+                "limit": limit,
+                "has_more": has_more,
+                "next_cursor": search_index.encode_cursor(terms, offset + limit) if has_more else None
+            }
+        }
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to delete class: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to search posts: {str(e)}")
 
 @app.post("/api/v1/classes/{class_id}/posts")
 async def create_post(class_id: str, request: CreatePostRequest, 
                      current_user: dict = Depends(get_current_user)):
     """Create new post in class"""
     try:
-        # Verify user is member of class
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        # Verify user is member of a class that exists and isn't being deleted
+        member, class_info = await asyncio.gather(
+            get_membership(db, class_id, current_user['uid']),
+            get_class_context_info(db, class_id)
+        )
+        if member is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
+        if class_info is None:
+            raise HTTPException(status_code=404, detail="Class not found")
         
         # Create post
         post_ref = (db.collection("classes").document(class_id)
@@ -1117,7 +1713,9 @@ async def create_post(class_id: str, request: CreatePostRequest,
             "createdAt": datetime.datetime.utcnow(),
             "isPublic": True
         }
-        post_ref.set(post_data)
+        await set_doc(post_ref, post_data)
+        remember_class_post(class_id, post_data)
+        search_index.add_post(class_id, post_ref.id, post_data)
         
         return {
             "message": "Post created successfully",
@@ -1133,10 +1731,10 @@ async def create_assignment(class_id: str, request: CreateAssignmentRequest, cur
     """Create an assignment (instructors only)."""
     try:
         # Verify membership and role
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        member = await get_membership(db, class_id, current_user['uid'])
+        if member is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
-        role = member_doc.to_dict().get("role")
+        role = member.get("role")
         if role != "instructor":
             raise HTTPException(status_code=403, detail="Only instructors can create assignments")
 
@@ -1151,7 +1749,7 @@ async def create_assignment(class_id: str, request: CreateAssignmentRequest, cur
             "createdAt": datetime.datetime.utcnow(),
             "createdBy": current_user['uid'],
         }
-        asg_ref.set(assignment_data)
+        await set_doc(asg_ref, assignment_data)
 
         return {"message": "Assignment created", "assignment_id": asg_ref.id}
     except HTTPException:
@@ -1163,15 +1761,18 @@ async def create_assignment(class_id: str, request: CreateAssignmentRequest, cur
 async def list_assignments(class_id: str, current_user: dict = Depends(get_current_user)):
     """List assignments for a class (students and instructors)."""
     try:
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
-            raise HTTPException(status_code=403, detail="Not a member of this class")
-
         q = (db.collection("classes").document(class_id)
              .collection("assignments")
              .order_by("createdAt", direction=firestore.Query.DESCENDING))
+        member, assignment_docs = await asyncio.gather(
+            get_membership(db, class_id, current_user['uid']),
+            query_docs(q)
+        )
+        if member is None:
+            raise HTTPException(status_code=403, detail="Not a member of this class")
+
         results = []
-        for doc in q.stream():
+        for doc in assignment_docs:
             d = doc.to_dict()
             results.append({
                 "assignment_id": doc.id,
@@ -1190,17 +1791,19 @@ async def list_assignments(class_id: str, current_user: dict = Depends(get_curre
 async def get_class_roster(class_id: str, current_user: dict = Depends(get_current_user)):
     """Get class roster. Students see classmates; instructors see all students and their roles."""
     try:
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        member, members = await asyncio.gather(
+            get_membership(db, class_id, current_user['uid']),
+            query_docs(db.collection("classMembers").where("classId", "==", class_id))
+        )
+        if member is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
-        caller_role = member_doc.to_dict().get("role")
+        caller_role = member.get("role")
 
-        members = db.collection("classMembers").where("classId", "==", class_id).stream()
+        member_rows = [m.to_dict() for m in members]
+        profiles = await get_user_profiles(db, [mdata.get("userId") for mdata in member_rows])
         roster = []
-        for m in members:
-            mdata = m.to_dict()
-            user_doc = db.collection("users").document(mdata.get("userId")).get()
-            u = user_doc.to_dict() if user_doc.exists else {}
+        for mdata in member_rows:
+            u = profiles.get(mdata.get("userId"), {})
             roster.append({
                 "user_id": mdata.get("userId"),
                 "full_name": u.get("full_name", "Unknown"),
@@ -1219,16 +1822,20 @@ async def get_class_roster(class_id: str, current_user: dict = Depends(get_curre
 async def remove_student_from_class(class_id: str, student_id: str, current_user: dict = Depends(get_current_user)):
     """Remove a student from a class (instructors only)."""
     try:
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists or member_doc.to_dict().get("role") != "instructor":
+        # Caller role and target membership are independent reads
+        member, target = await asyncio.gather(
+            get_membership(db, class_id, current_user['uid']),
+            get_membership(db, class_id, student_id)
+        )
+        if member is None or member.get("role") != "instructor":
             raise HTTPException(status_code=403, detail="Only instructors can remove students")
 
         # Ensure target student is in class
-        target_doc = db.collection("classMembers").document(f"{class_id}_{student_id}").get()
-        if not target_doc.exists:
+        if target is None:
             raise HTTPException(status_code=404, detail="Student not in this class")
 
-        db.collection("classMembers").document(f"{class_id}_{student_id}").delete()
+        await delete_doc(db.collection("classMembers").document(f"{class_id}_{student_id}"))
+        remember_membership(class_id, student_id, None)
         return {"message": "Student removed"}
     except HTTPException:
         raise
@@ -1239,56 +1846,150 @@ async def remove_student_from_class(class_id: str, student_id: str, current_user
 async def set_student_grade(class_id: str, request: SetGradeRequest, student_id: str, current_user: dict = Depends(get_current_user)):
     """Set a grade for a student on an assignment (instructors only)."""
     try:
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists or member_doc.to_dict().get("role") != "instructor":
+        member, student = await asyncio.gather(
+            get_membership(db, class_id, current_user['uid']),
+            get_membership(db, class_id, student_id)
+        )
+        if member is None or member.get("role") != "instructor":
             raise HTTPException(status_code=403, detail="Only instructors can set grades")
         # Ensure student is in class
-        stu_doc = db.collection("classMembers").document(f"{class_id}_{student_id}").get()
-        if not stu_doc.exists:
+        if student is None:
             raise HTTPException(status_code=404, detail="Student not in this class")
 
-        grade_ref = (db.collection("classes").document(class_id)
-                     .collection("grades").document(f"{request.assignment_id}_{student_id}"))
-        grade_ref.set({
-            "assignmentId": request.assignment_id,
-            "studentId": student_id,
-            "grade": request.grade,
-            "updatedAt": datetime.datetime.utcnow(),
-            "updatedBy": current_user['uid'],
-        })
+        # Grade doc and the student's aggregate are written in one transaction
+        await grades.set_grades(db, class_id, student_id, {request.assignment_id: request.grade}, current_user['uid'])
         return {"message": "Grade saved"}
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to set grade: {str(e)}")
 
+def parse_bulk_grade_rows(content_type: str, body: bytes) -> List[dict]:
+    """Rows from a CSV (header student_id,assignment_id,grade) or JSON body"""
+    try:
+        if "csv" in content_type:
+            reader = csv.DictReader(io.StringIO(body.decode("utf-8-sig")))
+            return [{k.strip(): (v or "").strip() for k, v in row.items() if k} for row in reader]
+        data = json.loads(body)
+    except (UnicodeDecodeError, ValueError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Could not parse grades: {str(e)}")
+    rows = data.get("grades") if isinstance(data, dict) else data
+    if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+        raise HTTPException(status_code=400, detail="Expected a list of {student_id, assignment_id, grade} rows")
+    return rows
+
+@app.post("/api/v1/classes/{class_id}/grades/bulk")
+async def import_student_grades(class_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    """Set many grades at once (instructors only).
+
+    The body is either JSON (`{"grades": [{student_id, assignment_id, grade}]}`
+    or the bare list) or CSV with a `student_id,assignment_id,grade` header.
+    Rows are checked against one roster scan and one assignments scan; bad
+    rows are reported and skipped. When a student/assignment pair repeats,
+    the last row wins. Each row gets a result with status `saved`, `error`
+    or `superseded`.
+    """
+    try:
+        rows = parse_bulk_grade_rows(request.headers.get("content-type", ""), await request.body())
+        if len(rows) > BULK_GRADE_MAX_ROWS:
+            raise HTTPException(status_code=413, detail=f"At most {BULK_GRADE_MAX_ROWS} rows per import")
+
+        roster_query = (db.collection("classMembers")
+                        .where("classId", "==", class_id).where("role", "==", "student"))
+        member, members, assignment_docs = await asyncio.gather(
+            get_membership(db, class_id, current_user['uid']),
+            query_docs(roster_query),
+            query_docs(db.collection("classes").document(class_id).collection("assignments"))
+        )
+        if member is None or member.get("role") != "instructor":
+            raise HTTPException(status_code=403, detail="Only instructors can set grades")
+        roster = {m.to_dict().get("userId") for m in members}
+        assignment_ids = {doc.id for doc in assignment_docs}
+
+        results = []
+        latest = {}  # (student_id, assignment_id) -> index into results
+        for index, row in enumerate(rows, start=1):
+            student_id = str(row.get("student_id") or "").strip()
+            assignment_id = str(row.get("assignment_id") or "").strip()
+            result = {"row": index, "student_id": student_id, "assignment_id": assignment_id}
+            results.append(result)
+            raw_grade = row.get("grade")
+            try:
+                grade = None if isinstance(raw_grade, bool) else float(raw_grade)
+            except (TypeError, ValueError):
+                grade = None
+            # Rejects NaN and infinities too: they would poison the aggregate's mean
+            error = None if grade is not None and math.isfinite(grade) else "Grade must be a finite number"
+            if not student_id or not assignment_id:
+                error = "student_id and assignment_id are required"
+            elif student_id not in roster:
+                error = "Student not in this class"
+            elif assignment_id not in assignment_ids:
+                error = "Assignment not found"
+            if error:
+                result.update(status="error", error=error)
+                continue
+
+            key = (student_id, assignment_id)
+            if key in latest:
+                previous = results[latest[key]]
+                previous.update(status="superseded", error=f"Overridden by row {index}")
+            latest[key] = index - 1
+            result.update(status="saved", grade=grade)
+
+        grades_by_student = {}
+        for student_id, assignment_id in latest:
+            result = results[latest[(student_id, assignment_id)]]
+            grades_by_student.setdefault(student_id, {})[assignment_id] = result["grade"]
+        if grades_by_student:
+            # Chunked batch commits with a single aggregate write per student
+            failed_students = await grades.import_grades(db, class_id, grades_by_student, current_user['uid'])
+            for index in latest.values():
+                result = results[index]
+                if result["student_id"] in failed_students:
+                    result.update(status="error", error=f"Write failed: {failed_students[result['student_id']]}")
+
+        saved = sum(1 for r in results if r["status"] == "saved")
+        failed = sum(1 for r in results if r["status"] == "error")
+        return {
+            "summary": {"total": len(results), "saved": saved, "failed": failed,
+                        "superseded": len(results) - saved - failed},
+            "results": results,
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to import grades: {str(e)}")
+
 @app.get("/api/v1/classes/{class_id}/grades/student/{student_id}")
 async def get_student_grades(class_id: str, student_id: str, current_user: dict = Depends(get_current_user)):
     """Get all grades for a student in a class. Students can view their own; instructors can view any."""
     try:
-        caller_member = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not caller_member.exists:
+        caller_member, aggregate = await asyncio.gather(
+            get_membership(db, class_id, current_user['uid']),
+            grades.get_aggregate(db, class_id, student_id)
+        )
+        if caller_member is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
-        caller_role = caller_member.to_dict().get("role")
+        caller_role = caller_member.get("role")
         if current_user['uid'] != student_id and caller_role != "instructor":
             raise HTTPException(status_code=403, detail="Not allowed")
 
-        q = db.collection("classes").document(class_id).collection("grades").where("studentId", "==", student_id)
-        grades = []
-        total = 0.0
-        count = 0
-        for gdoc in q.stream():
-            g = gdoc.to_dict()
-            grades.append({
-                "assignment_id": g.get("assignmentId"),
-                "grade": g.get("grade"),
-                "updated_at": serialize_datetime(g.get("updatedAt")),
-            })
-            if isinstance(g.get("grade"), (int, float)):
-                total += float(g.get("grade"))
-                count += 1
-        final_grade = (total / count) if count else None
-        return {"grades": grades, "final_grade": final_grade}
+        if aggregate is None:
+            # Grades written before aggregates existed and not yet rebuilt
+            q = (db.collection("classes").document(class_id)
+                 .collection(grades.GRADES_SUBCOLLECTION).where("studentId", "==", student_id))
+            aggregate = grades.aggregate_from_grade_docs(student_id, [g.to_dict() for g in await query_docs(q)])
+
+        student_grades = [
+            {
+                "assignment_id": assignment_id,
+                "grade": entry.get("grade"),
+                "updated_at": serialize_datetime(entry.get("updatedAt")),
+            }
+            for assignment_id, entry in aggregate["grades"].items()
+        ]
+        return {"grades": student_grades, "final_grade": aggregate["mean"]}
     except HTTPException:
         raise
     except Exception as e:
@@ -1298,17 +1999,20 @@ async def get_student_grades(class_id: str, student_id: str, current_user: dict
 async def get_assignment_grades(class_id: str, assignment_id: str, current_user: dict = Depends(get_current_user)):
     """List all student grades for an assignment (instructors only)."""
     try:
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists or member_doc.to_dict().get("role") != "instructor":
-            raise HTTPException(status_code=403, detail="Only instructors can view assignment grades")
-
         q = (db.collection("classes").document(class_id)
              .collection("grades").where("assignmentId", "==", assignment_id))
+        member, grade_docs = await asyncio.gather(
+            get_membership(db, class_id, current_user['uid']),
+            query_docs(q)
+        )
+        if member is None or member.get("role") != "instructor":
+            raise HTTPException(status_code=403, detail="Only instructors can view assignment grades")
+
+        grade_rows = [gdoc.to_dict() for gdoc in grade_docs]
+        profiles = await get_user_profiles(db, [g.get("studentId") for g in grade_rows])
         results = []
-        for gdoc in q.stream():
-            g = gdoc.to_dict()
-            user_doc = db.collection("users").document(g.get("studentId", "")).get()
-            u = user_doc.to_dict() if user_doc.exists else {}
+        for g in grade_rows:
+            u = profiles.get(g.get("studentId"), {})
             results.append({
                 "student_id": g.get("studentId"),
                 "student_name": u.get("full_name", "Unknown"),
@@ -1322,6 +2026,101 @@ async def get_assignment_grades(class_id: str, assignment_id: str, current_user:
         raise HTTPException(status_code=500, detail=f"Failed to get assignment grades: {str(e)}")
 
 
+@app.get("/api/v1/classes/{class_id}/gradebook")
+async def get_gradebook(class_id: str, student_limit: int = 50, student_cursor: Optional[str] = None,
+                        assignment_limit: int = 20, assignment_offset: int = 0,
+                        current_user: dict = Depends(get_current_user)):
+    """Students x assignments grade matrix (instructors only).
+
+    Rows are students ordered by id and paged with `student_cursor` (the
+    `next_cursor` of the previous page); columns are assignments, newest first,
+    paged with `assignment_offset`. `grades[i][j]` is student i's grade on
+    assignment j, or null. `final_grade` is the mean over all assignments.
+    """
+    try:
+        student_limit = max(1, min(student_limit, 200))
+        assignment_limit = max(1, min(assignment_limit, 50))
+        members_ref = db.collection("classMembers")
+        roster_query = (members_ref.where("classId", "==", class_id).where("role", "==", "student")
+                        .order_by(firestore.FieldPath.document_id()))
+        if student_cursor:
+            roster_query = roster_query.start_after([members_ref.document(f"{class_id}_{student_cursor}")])
+        assignments_query = (db.collection("classes").document(class_id)
+                             .collection("assignments")
+                             .order_by("createdAt", direction=firestore.Query.DESCENDING))
+
+        # One roster page scan (one extra row to detect more) and one assignments scan
+        member, members, assignment_docs = await asyncio.gather(
+            get_membership(db, class_id, current_user['uid']),
+            query_docs(roster_query.limit(student_limit + 1)),
+            query_docs(assignments_query)
+        )
+        if member is None or member.get("role") != "instructor":
+            raise HTTPException(status_code=403, detail="Only instructors can view the gradebook")
+
+        has_more_students = len(members) > student_limit
+        student_ids = [m.to_dict().get("userId") for m in members[:student_limit]]
+        columns = [(doc.id, doc.to_dict()) for doc in assignment_docs[assignment_offset:assignment_offset + assignment_limit]]
+
+        # Each student's aggregate holds all their grades; names come from the shared cache
+        aggregate_docs, names = await asyncio.gather(
+            get_docs(db, [grades.aggregate_ref(db, class_id, sid) for sid in student_ids]),
+            get_author_names(db, student_ids)
+        )
+        aggregates = {sid: snap.to_dict() for sid, snap in aggregate_docs.items() if snap.exists}
+        missing = [sid for sid in student_ids if sid not in aggregates]
+        if missing:
+            # Students graded before aggregates existed: fall back to one scan of the class's grades
+            by_student = {sid: [] for sid in missing}
+            grades_query = db.collection("classes").document(class_id).collection(grades.GRADES_SUBCOLLECTION)
+            for gdoc in await query_docs(grades_query):
+                g = gdoc.to_dict()
+                if g.get("studentId") in by_student:
+                    by_student[g["studentId"]].append(g)
+            for sid, grade_docs in by_student.items():
+                aggregates[sid] = grades.aggregate_from_grade_docs(sid, grade_docs)
+
+        students = []
+        matrix = []
+        for sid in student_ids:
+            entries = aggregates[sid].get("grades", {})
+            students.append({
+                "student_id": sid,
+                "student_name": names.get(sid, "Unknown"),
+                "final_grade": aggregates[sid].get("mean"),
+            })
+            matrix.append([entries.get(assignment_id, {}).get("grade") for assignment_id, _ in columns])
+
+        return {
+            "assignments": [
+                {
+                    "assignment_id": assignment_id,
+                    "title": d.get("title"),
+                    "due_date": serialize_datetime(d.get("dueDate")) if isinstance(d.get("dueDate"), datetime.datetime) else d.get("dueDate"),
+                }
+                for assignment_id, d in columns
+            ],
+            "students": students,
+            "grades": matrix,
+            "pagination": {
+                "students": {
+                    "limit": student_limit,
+                    "has_more": has_more_students,
+                    "next_cursor": student_ids[-1] if has_more_students else None,
+                },
+                "assignments": {
+                    "limit": assignment_limit,
+                    "offset": assignment_offset,
+                    "total": len(assignment_docs),
+                    "has_more": assignment_offset + assignment_limit < len(assignment_docs),
+                },
+            },
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get gradebook: {str(e)}")
+
 @app.get("/api/v1/posts/{post_id}")
 async def get_post_details(post_id: str, current_user: dict = Depends(mock_get_current_user)):
     """Get specific post details"""
@@ -1343,101 +2142,223 @@ async def chat_with_study_buddy_files(
     message: str = "",
     conversation_id: Optional[str] = None,
     class_context: Optional[str] = None,
+    stream: bool = False,
     files: List[UploadFile] = File(default=[]),
     current_user: dict = Depends(mock_get_current_user)
 ):
-    """Chat with AI Study Buddy including file analysis"""
+    """Chat with AI Study Buddy including file analysis. Pass ?stream=true for server-sent events."""
     try:
         if not OPENAI_API_KEY or OPENAI_API_KEY == "your-openai-api-key-here":
             raise HTTPException(status_code=503, detail="AI service not configured")
         
-        # Process uploaded files
-        files_content = []
-        file_types = []
-        
-        for file in files:
-            if file.filename.lower().endswith('.pdf'):
-                pdf_text = extract_pdf_text(file)
-                files_content.append({
+        # Process uploaded files concurrently
+        async def process_file(filename: str, data: bytes):
+            if filename.lower().endswith('.pdf'):
+                pdf_text = await extract_pdf_text(data, max_chars=CHAT_FILE_CONTENT_CHARS)
+                return "pdf", {
                     "type": "text",
-                    "content": f"PDF content from {file.filename}:\n{pdf_text[:2000]}"  # Limit length
-                })
-                file_types.append("pdf")
-                
-            elif file.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-                base64_image = process_image(file)
-                files_content.append({
-                    "type": "image_url",
-                    "image_url": {"url": base64_image}
-                })
-                file_types.append("image")
+                    "content": f"PDF content from {filename}:\n{pdf_text}"
+                }
+            # Anything else may be an image whatever its extension (.webp, .gif, none);
+            # normalize_image detects the real format and rejects non-images
+            base64_image = await process_image(filename, data)
+            return "image", {
+                "type": "image_url",
+                "image_url": {"url": base64_image}
+            }
+        
+        processed, file_errors = await process_files(await read_uploads(files), process_file)
+        file_types = [file_type for file_type, _ in processed]
+        files_content = [content for _, content in processed]
         
         # Generate or use existing conversation ID
         conversation_id = conversation_id or str(uuid.uuid4())
         
-        # Get or create conversation history
-        conv_doc_ref = db.collection("ai_conversations").document(conversation_id)
-        conv_doc = conv_doc_ref.get()
-        
-        if conv_doc.exists:
-            conv_data = conv_doc.to_dict()
-            conversation_history = conv_data.get("messages", [])
-        else:
-            conversation_history = [
-                {"role": "system", "content": STUDY_BUDDY_SYSTEM_PROMPT}
-            ]
+        # Get recent conversation history and class context (if provided) concurrently
+        conv_ref = db.collection("ai_conversations").document(conversation_id)
+        user_sent_at = datetime.datetime.utcnow()
+        (header, recent_messages), class_context_text = await asyncio.gather(
+            conversations.load_conversation(conv_ref),
+            get_class_context(class_context, db)
+        )
         
         # Create user message
         user_message = message if message else "Can you help me understand these files?"
-        conversation_history.append({"role": "user", "content": user_message})
+        file_tokens = sum(count_tokens(f["content"]) for f in files_content if f["type"] == "text")
+        conversation_history = await prepare_prompt_history(
+            conv_ref, header, recent_messages, user_message, class_context_text, OPENAI_API_KEY,
+            reserved_tokens=file_tokens
+        )
         
-        # Get class context if provided
-        class_context_text = ""
-        if class_context:
-            class_context_text = get_class_context(class_context, db)
+        async def finish(ai_response: str):
+            # Append this turn to the conversation in Firestore
+            await conversations.append_messages(db, conv_ref, [
+                {"role": "user", "content": user_message, "created_at": user_sent_at},
+                {"role": "assistant", "content": ai_response}
+            ], class_id=class_context, user_id=current_user['uid'], file_types=file_types)
+        
+        if stream:
+            payload = build_chat_with_files_payload(conversation_history, files_content, class_context_text)
+            return stream_ai_response(payload, OPENAI_API_KEY, conversation_id, finish)
         
         # Get AI response with files
-        ai_response = get_ai_response_with_files(
+        ai_response = await get_ai_response_with_files(
             conversation_history, 
             OPENAI_API_KEY, 
             files_content,
             class_context_text
         )
-        
-        # Add AI response to history
-        conversation_history.append({"role": "assistant", "content": ai_response})
-        
-        # Save conversation to Firestore
-        conv_data = {
-            "conversation_id": conversation_id,
-            "messages": conversation_history,
-            "class_id": class_context,
-            "user_id": current_user['uid'],
-            "created_at": conv_doc.get("created_at") if conv_doc.exists else datetime.datetime.utcnow(),
-            "last_updated": datetime.datetime.utcnow(),
-            "file_types": file_types
-        }
-        conv_doc_ref.set(conv_data)
+        await finish(ai_response)
         
         return {
             "response": ai_response,
             "conversation_id": conversation_id,
             "timestamp": datetime.datetime.utcnow().isoformat(),
             "processed_files": len(files),
-            "file_types": file_types
+            "file_types": file_types,
+            "file_errors": file_errors
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"File analysis error: {str(e)}")
     
 
+async def analyze_notes(uploads: List[Tuple[str, bytes]], request: NoteSummaryRequest, user_id: str,
+                        on_progress=None) -> SummaryResponse:
+    """Summarise uploaded files and store the result as a note_summaries document.
+
+    `on_progress` is passed to get_map_reduce_summary in long-document mode.
+    """
+    # Process files concurrently and combine content in upload order.
+    # Each file gives (header naming the file, extracted text).
+    async def process_file(filename: str, data: bytes) -> Tuple[str, str]:
+        if filename.lower().endswith('.pdf'):
+            if request.long_document:
+                pdf_text = await extract_pdf_text(data, max_tokens=LONG_DOCUMENT_MAX_TOKENS,
+                                                  first_page=request.first_page or 1, last_page=request.last_page)
+            else:
+                # Only the first SUMMARY_CONTENT_CHARS of the combined content reach the model
+                pdf_text = await extract_pdf_text(data, max_chars=SUMMARY_CONTENT_CHARS,
+                                                  first_page=request.first_page or 1, last_page=request.last_page)
+            return f"\n\n--- Content from {filename} ---\n", pdf_text
+        elif filename.lower().endswith('.txt'):
+            text_content = data.decode('utf-8')
+            if request.long_document:
+                # Same cap as PDFs; a token is rarely more than 8 characters, so trim cheaply first
+                text_content = split_tokens(text_content[:LONG_DOCUMENT_MAX_TOKENS * 8], LONG_DOCUMENT_MAX_TOKENS)[0]
+            return f"\n\n--- Content from {filename} ---\n", text_content
+        # Otherwise it may be an image under any extension; detect it from the bytes
+        try:
+            await run_ingest(ingest.image_format, data)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"{filename}: unsupported file type ({str(e)})")
+        # For images, we'll need to use GPT-4 Vision - simplified for now
+        return f"\n\n--- Image file: {filename} (image analysis not implemented in JSON mode) ---\n", ""
+    
+    file_sources = [filename for filename, _ in uploads]
+    sections, file_errors = await process_files(uploads, process_file)
+    combined_content = "".join(header + text for header, text in sections)
+    # File names are left out of cache keys and long-document chunks, so the same
+    # notes uploaded under a different name reuse cached summaries
+    source_text = "\n\n".join(text for _, text in sections if text)
+    
+    if not combined_content.strip():
+        detail = "No readable content found in uploaded files"
+        if file_errors:
+            detail += ": " + "; ".join(f"{e['filename']}: {e['error']}" for e in file_errors)
+        raise HTTPException(status_code=400, detail=detail)
+    
+    if request.long_document and not source_text.strip():
+        raise HTTPException(status_code=400, detail="Long-document mode needs text from a PDF or .txt file")
+    
+    # Get structured summary from AI
+    if request.long_document:
+        summary_data = await get_map_reduce_summary(source_text, OPENAI_API_KEY, request.title, on_progress)
+    else:
+        summary_data = await get_structured_summary(
+            combined_content, 
+            OPENAI_API_KEY, 
+            request.title,
+            cache_content=source_text
+        )
+    
+    # Generate summary ID and create database document
+    summary_id = str(uuid.uuid4())
+    
+    # Use provided title or AI-generated one
+    final_title = request.title or summary_data.get("title", "Study Notes")
+    
+    # Create NoteSummary object
+    note_summary = NoteSummary(
+        summary_id=summary_id,
+        title=final_title,
+        key_concepts=summary_data.get("key_concepts", []),
+        main_points=summary_data.get("main_points", []),
+        study_tips=summary_data.get("study_tips", []),
+        questions_for_review=summary_data.get("questions_for_review", []),
+        difficulty_level=summary_data.get("difficulty_level", "intermediate"),
+        estimated_study_time=summary_data.get("estimated_study_time", "30 minutes"),
+        created_at=datetime.datetime.utcnow().isoformat(),
+        file_sources=file_sources,
+        class_id=request.class_id,
+        user_id=user_id
+    )
+    
+    # Store in Firestore
+    summary_doc = {
+        "summary_id": summary_id,
+        "title": final_title,
+        "key_concepts": summary_data.get("key_concepts", []),
+        "main_points": summary_data.get("main_points", []),
+        "study_tips": summary_data.get("study_tips", []),
+        "questions_for_review": summary_data.get("questions_for_review", []),
+        "difficulty_level": summary_data.get("difficulty_level", "intermediate"),
+        "estimated_study_time": summary_data.get("estimated_study_time", "30 minutes"),
+        "created_at": datetime.datetime.utcnow(),
+        "file_sources": file_sources,
+        "class_id": request.class_id,
+        "user_id": user_id,
+        "raw_content": combined_content[:1000]  # Store preview of original content
+    }
+    
+    await set_doc(db.collection("note_summaries").document(summary_id), summary_doc)
+    
+    return SummaryResponse(
+        summary=note_summary,
+        raw_content_preview=combined_content[:200] + "..." if len(combined_content) > 200 else combined_content,
+        file_errors=file_errors
+    )
+
+async def run_analyze_notes_job(job: jobs.Job) -> dict:
+    """Queued form of analyze_notes; client errors fail the job instead of being retried"""
+    async def report_progress(done: int, total: int):
+        await job.report(done / total, chunks_done=done, chunks_total=total)
+    
+    try:
+        response = await analyze_notes(await job.files(), NoteSummaryRequest(**job.payload), job.user_id,
+                                       on_progress=report_progress)
+    except HTTPException as e:
+        if e.status_code < 500:
+            raise jobs.PermanentJobError(e.detail)
+        raise
+    return response.model_dump()
+
+jobs.queue.register("analyze_notes", run_analyze_notes_job)
+
 @app.post("/api/v1/notes/analyze", response_model=SummaryResponse)
 async def analyze_notes_to_json(
     files: List[UploadFile] = File(...),
     request: NoteSummaryRequest = Depends(),
+    async_mode: bool = Query(False, alias="async"),
     current_user: dict = Depends(mock_get_current_user)
 ):
-    """Analyze uploaded files and return structured JSON summary"""
+    """Analyze uploaded files and return structured JSON summary.
+
+    With ?async=true the files are queued instead and the response is 202 with
+    a job id; poll /api/v1/jobs/{job_id} for the result.
+    """
     try:
         if not OPENAI_API_KEY or OPENAI_API_KEY == "your-openai-api-key-here":
             raise HTTPException(status_code=503, detail="AI service not configured")
@@ -1445,86 +2366,45 @@ async def analyze_notes_to_json(
         if not files:
             raise HTTPException(status_code=400, detail="No files uploaded")
         
-        # Process files and combine content
-        combined_content = ""
-        file_sources = []
-        
-        for file in files:
-            file_sources.append(file.filename)
-            
-            if file.filename.lower().endswith('.pdf'):
-                pdf_text = extract_pdf_text(file)
-                combined_content += f"\n\n--- Content from {file.filename} ---\n{pdf_text}"
-                
-            elif file.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-                # For images, we'll need to use GPT-4 Vision - simplified for now
-                combined_content += f"\n\n--- Image file: {file.filename} (image analysis not implemented in JSON mode) ---\n"
-            
-            elif file.filename.lower().endswith('.txt'):
-                text_content = (await file.read()).decode('utf-8')
-                combined_content += f"\n\n--- Content from {file.filename} ---\n{text_content}"
-        
-        if not combined_content.strip():
-            raise HTTPException(status_code=400, detail="No readable content found in uploaded files")
-        
-        # Get structured summary from AI
-        summary_data = get_structured_summary(
-            combined_content, 
-            OPENAI_API_KEY, 
-            request.title
-        )
-        
-        # Generate summary ID and create database document
-        summary_id = str(uuid.uuid4())
-        
-        # Use provided title or AI-generated one
-        final_title = request.title or summary_data.get("title", "Study Notes")
-        
-        # Create NoteSummary object
-        note_summary = NoteSummary(
-            summary_id=summary_id,
-            title=final_title,
-            key_concepts=summary_data.get("key_concepts", []),
-            main_points=summary_data.get("main_points", []),
-            study_tips=summary_data.get("study_tips", []),
-            questions_for_review=summary_data.get("questions_for_review", []),
-            difficulty_level=summary_data.get("difficulty_level", "intermediate"),
-            estimated_study_time=summary_data.get("estimated_study_time", "30 minutes"),
-            created_at=datetime.datetime.utcnow().isoformat(),
-            file_sources=file_sources,
-            class_id=request.class_id,
-            user_id=current_user['uid']
-        )
-        
-        # Store in Firestore
-        summary_doc = {
-            "summary_id": summary_id,
-            "title": final_title,
-            "key_concepts": summary_data.get("key_concepts", []),
-            "main_points": summary_data.get("main_points", []),
-            "study_tips": summary_data.get("study_tips", []),
-            "questions_for_review": summary_data.get("questions_for_review", []),
-            "difficulty_level": summary_data.get("difficulty_level", "intermediate"),
-            "estimated_study_time": summary_data.get("estimated_study_time", "30 minutes"),
-            "created_at": datetime.datetime.utcnow(),
-            "file_sources": file_sources,
-            "class_id": request.class_id,
-            "user_id": current_user['uid'],
-            "raw_content": combined_content[:1000]  # Store preview of original content
-        }
-        
-        db.collection("note_summaries").document(summary_id).set(summary_doc)
+        uploads = await read_uploads(files)
+        if async_mode:
+            job_id = await jobs.queue.submit("analyze_notes", request.model_dump(), uploads, user_id=current_user['uid'])
+            return JSONResponse(status_code=202, content={
+                "job_id": job_id,
+                "status": jobs.QUEUED,
+                "status_url": f"/api/v1/jobs/{job_id}"
+            })
         
-        return SummaryResponse(
-            summary=note_summary,
-            raw_content_preview=combined_content[:200] + "..." if len(combined_content) > 200 else combined_content
-        )
+        return await analyze_notes(uploads, request, current_user['uid'])
         
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Note analysis failed: {str(e)}")
 
+@app.get("/api/v1/jobs/{job_id}")
+async def get_job_status(job_id: str, current_user: dict = Depends(mock_get_current_user)):
+    """Status, progress and (once finished) result of a background job"""
+    job = await jobs.queue.get(job_id)
+    if not job or job["user_id"] != current_user['uid']:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    job.pop("user_id")
+    job["created_at"] = datetime.datetime.utcfromtimestamp(job["created_at"]).isoformat()
+    job["updated_at"] = datetime.datetime.utcfromtimestamp(job["updated_at"]).isoformat()
+    return job
+
+@app.delete("/api/v1/jobs/{job_id}")
+async def cancel_job(job_id: str, current_user: dict = Depends(mock_get_current_user)):
+    """Cancel a queued or running job; a running job stops at its next progress update"""
+    job = await jobs.queue.get(job_id)
+    if not job or job["user_id"] != current_user['uid']:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    if not await jobs.queue.cancel(job_id):
+        raise HTTPException(status_code=409, detail=f"Job already {job['status']}")
+    return {"job_id": job_id, "status": jobs.CANCELLED}
+
 # Get user's summaries
 @app.get("/api/v1/summaries")
 async def get_user_summaries(
@@ -1539,7 +2419,7 @@ async def get_user_summaries(
         if class_id:
             query = query.where("class_id", "==", class_id)
         
-        summaries = query.order_by("created_at", direction=firestore.Query.DESCENDING).limit(limit).stream()
+        summaries = await query_docs(query.order_by("created_at", direction=firestore.Query.DESCENDING).limit(limit))
         
         summary_list = []
         for summary_doc in summaries:
@@ -1568,7 +2448,7 @@ async def get_summary_details(
 ):
     """Get detailed summary by ID"""
     try:
-        summary_doc = db.collection("note_summaries").document(summary_id).get()
+        summary_doc = await get_doc(db.collection("note_summaries").document(summary_id))
         
         if not summary_doc.exists:
             raise HTTPException(status_code=404, detail="Summary not found")
@@ -1608,8 +2488,8 @@ async def get_class_summaries(
     """Get all summaries for a specific class"""
     try:
         # Verify user is member of class
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        member = await get_membership(db, class_id, current_user['uid'])
+        if member is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
         
         return await get_user_summaries(class_id=class_id, current_user=current_user)
@@ -1627,6 +2507,20 @@ async def get_class_summaries(
 async def health_check():
     return {"message": "Classroom API v1.0.0 is running ✅", "timestamp": datetime.datetime.utcnow().isoformat()}
 
+@app.get("/api/v1/metrics")
+async def get_metrics():
+    """In-process cache hit/miss counters and ingest pool saturation for this instance"""
+    return {
+        "caches": {
+            **data_access.cache_stats(),
+            "id_tokens": auth_tokens.token_cache.stats(),
+            "note_summaries": summary_cache.local_cache.stats(),
+            "search_indexes": search_index.stats(),
+        },
+        "ingest_pool": ingest.pool.stats(),
+        "timestamp": datetime.datetime.utcnow().isoformat()
+    }
+
 if __name__ == "__main__":
     import uvicorn
     import os
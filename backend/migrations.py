@@ -0,0 +1,152 @@
+"""One-off Firestore backfills and rebuilds.
+
+Run from the backend directory with the same credentials as the API, e.g.:
+
+    python migrations.py backfill-membership-class-info
+"""
+import argparse
+
+from firebase_admin import firestore
+
+import conversations
+import grades
+from data_access import BatchWriter
+from main import db, generate_class_code, CLASS_CODE_MAX_ATTEMPTS
+
+
+def backfill_membership_class_info() -> int:
+    """Copy className/classCode onto classMembers docs written before they were denormalised"""
+    classes = {}
+    writer = BatchWriter(db)
+    updated = 0
+    for member in db.collection("classMembers").stream():
+        data = member.to_dict()
+        if "className" in data and "classCode" in data:
+            continue
+
+        class_id = data.get("classId")
+        if class_id not in classes:
+            class_doc = db.collection("classes").document(class_id).get()
+            classes[class_id] = class_doc.to_dict() if class_doc.exists else None
+        class_data = classes[class_id]
+        if class_data is None:
+            continue
+
+        writer.update(member.reference, {
+            "className": class_data.get("name"),
+            "classCode": class_data.get("code"),
+        })
+        updated += 1
+
+    writer.flush()
+    return updated
+
+
+def migrate_conversation_messages() -> int:
+    """Move legacy inline ai_conversations.messages arrays into the messages subcollection"""
+    migrated = 0
+    for conv in db.collection("ai_conversations").stream():
+        data = conv.to_dict()
+        if "messages" not in data:
+            continue
+
+        # Legacy turns take seq 0..n-1; anything appended since already starts at n
+        legacy = [m for m in data["messages"] if m.get("role") != "system"]
+        messages_ref = conv.reference.collection(conversations.MESSAGES_SUBCOLLECTION)
+        writer = BatchWriter(db)
+        for seq, msg in enumerate(legacy):
+            writer.set(messages_ref.document(conversations.message_id(seq)), {
+                "role": msg.get("role"),
+                "content": msg.get("content"),
+                "seq": seq,
+                "created_at": data.get("last_updated"),
+            })
+
+        header = conversations.summarize_header(data)
+        writer.update(conv.reference, {
+            "messages": firestore.DELETE_FIELD,
+            "message_count": header["message_count"],
+            "preview": header["preview"],
+        })
+        writer.flush()
+        migrated += 1
+    return migrated
+
+
+def backfill_class_codes() -> int:
+    """Index existing classes in classCodes/{code}, oldest first.
+
+    A class whose code is already taken by an older class gets a fresh code
+    (copied onto its memberships), since duplicates made joins ambiguous.
+    """
+    updated = 0
+    for class_doc in db.collection("classes").order_by("createdAt").stream():
+        data = class_doc.to_dict()
+        code = data.get("code")
+        code_ref = db.collection("classCodes").document(code) if code else None
+        existing = code_ref.get() if code_ref else None
+        if existing is not None and existing.exists and existing.to_dict().get("classId") == class_doc.id:
+            continue
+
+        if existing is None or existing.exists:
+            for _ in range(CLASS_CODE_MAX_ATTEMPTS):
+                code = generate_class_code()
+                code_ref = db.collection("classCodes").document(code)
+                if not code_ref.get().exists:
+                    break
+            else:
+                raise RuntimeError(f"Could not allocate a unique code for class {class_doc.id}")
+            print(f"  class {class_doc.id}: code {data.get('code')} reassigned to {code}")
+
+            writer = BatchWriter(db)
+            writer.update(class_doc.reference, {"code": code})
+            for member in db.collection("classMembers").where("classId", "==", class_doc.id).stream():
+                writer.update(member.reference, {"classCode": code})
+            writer.flush()
+
+        code_ref.set({
+            "classId": class_doc.id,
+            "className": data.get("name"),
+            "createdAt": data.get("createdAt"),
+        })
+        updated += 1
+    return updated
+
+
+def rebuild_grade_aggregates() -> int:
+    """Recompute every classes/{id}/gradeAggregates doc from the raw grades"""
+    updated = 0
+    for class_doc in db.collection("classes").stream():
+        by_student = {}
+        for grade in class_doc.reference.collection(grades.GRADES_SUBCOLLECTION).stream():
+            data = grade.to_dict()
+            by_student.setdefault(data.get("studentId"), []).append(data)
+
+        writer = BatchWriter(db)
+        stale = [d.reference for d in class_doc.reference.collection(grades.AGGREGATES_SUBCOLLECTION).stream()
+                 if d.id not in by_student]
+        for ref in stale:
+            writer.delete(ref)
+        for student_id, grade_docs in by_student.items():
+            if not student_id:
+                continue
+            writer.set(grades.aggregate_ref(db, class_doc.id, student_id),
+                       grades.aggregate_from_grade_docs(student_id, grade_docs))
+            updated += 1
+        writer.flush()
+    return updated
+
+
+COMMANDS = {
+    "backfill-membership-class-info": backfill_membership_class_info,
+    "migrate-conversation-messages": migrate_conversation_messages,
+    "backfill-class-codes": backfill_class_codes,
+    "rebuild-grade-aggregates": rebuild_grade_aggregates,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a Firestore backfill or rebuild")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    args = parser.parse_args()
+    result = COMMANDS[args.command]()
+    print(f"✅ {args.command}: {result} documents updated")
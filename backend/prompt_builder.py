@@ -0,0 +1,101 @@
+"""Token counting and history fitting for chat prompts.
+
+Counts use tiktoken once load_encoding() has loaded its encoding, otherwise
+a ~4 characters per token estimate. Loading may download the BPE file (with
+no timeout) unless TIKTOKEN_CACHE_DIR already holds it, so it is never done
+lazily from count_tokens: the API loads it at startup off the event loop.
+"""
+import math
+import os
+from typing import Callable, Dict, List, Tuple
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - optional dependency
+    tiktoken = None
+
+# Total prompt tokens (system + context + summary + history + new message);
+# gpt-3.5-turbo has a 4k window and up to 500 tokens are reserved for the reply
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+
+# When history overflows, older turns are folded into the summary until the
+# rest fits in this fraction of the history budget, so compaction runs every
+# few turns rather than on every one
+COMPACTION_TARGET_RATIO = float(os.getenv("PROMPT_COMPACTION_TARGET", "0.6"))
+
+# Chat format overhead per message and for priming the reply
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 2
+
+_encoding = None
+_encoding_failed = False
+
+
+def load_encoding() -> bool:
+    """Load the tiktoken encoding if possible (blocking); True once it is in use"""
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            _encoding_failed = True
+            print(f"⚠️ tiktoken encoding unavailable, estimating tokens: {e}")
+    return _encoding is not None
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return math.ceil(len(text) / 4)
+
+
+def count_message_tokens(messages: List[Dict]) -> int:
+    total = TOKENS_PER_REPLY
+    for msg in messages:
+        content = msg.get("content")
+        total += TOKENS_PER_MESSAGE + (count_tokens(content) if isinstance(content, str) else 0)
+    return total
+
+
+def fit_history(messages: List[Dict], budget: int) -> Tuple[List[Dict], List[Dict]]:
+    """Split chronological messages into (older ones that don't fit, newest ones that do)"""
+    used = 0
+    start = len(messages)
+    while start > 0:
+        cost = TOKENS_PER_MESSAGE + count_tokens(messages[start - 1].get("content", ""))
+        if used + cost > budget:
+            break
+        used += cost
+        start -= 1
+    return messages[:start], messages[start:]
+
+
+def _message_cost(msg: Dict) -> int:
+    return TOKENS_PER_MESSAGE + count_tokens(msg.get("content", ""))
+
+
+def group_by_tokens(items: List, budget: int, cost: Callable[[object], int] = _message_cost) -> List[List]:
+    """Split items (chat messages by default) into consecutive groups of at most `budget`
+    tokens each; a single item over the budget gets a group of its own"""
+    groups, current, used = [], [], 0
+    for item in items:
+        item_cost = cost(item)
+        if current and used + item_cost > budget:
+            groups.append(current)
+            current, used = [], 0
+        current.append(item)
+        used += item_cost
+    if current:
+        groups.append(current)
+    return groups
+
+
+def split_tokens(text: str, chunk_tokens: int) -> List[str]:
+    """Split text into consecutive chunks of at most `chunk_tokens` tokens"""
+    if _encoding is None:
+        size = chunk_tokens * 4
+        return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+    tokens = _encoding.encode(text)
+    return [_encoding.decode(tokens[i:i + chunk_tokens]) for i in range(0, len(tokens), chunk_tokens)] or [""]
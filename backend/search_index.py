@@ -0,0 +1,232 @@
+"""In-memory full-text search over a class's posts.
+
+Each class gets an inverted index (term -> {post_id: term frequency}) built
+lazily from `classes/{class_id}/posts` on its first search and kept in an
+LRU of SEARCH_INDEX_MAX_CLASSES classes. Results are ranked with BM25; title
+and tag terms count double. `create_post` adds new posts to this instance's
+index directly, and every SEARCH_INDEX_REFRESH seconds a search first pulls in
+posts created since the last sync, e.g. by other instances. After
+SEARCH_INDEX_TTL the index is dropped and rebuilt from Firestore.
+"""
+import asyncio
+import datetime
+import hashlib
+import heapq
+import math
+import os
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+import cursors
+from cache import TTLCache
+from data_access import run_blocking, query_docs
+
+SEARCH_INDEX_MAX_CLASSES = int(os.getenv("SEARCH_INDEX_MAX_CLASSES", "100"))
+SEARCH_INDEX_TTL = float(os.getenv("SEARCH_INDEX_TTL", "1800"))
+SEARCH_INDEX_REFRESH = float(os.getenv("SEARCH_INDEX_REFRESH", "30"))
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+TITLE_WEIGHT = 2
+
+SNIPPET_CHARS = 160
+# Re-read posts this far behind the sync watermark to allow for clock skew between instances
+SYNC_OVERLAP = datetime.timedelta(seconds=5)
+
+POST_FIELDS = ["title", "content", "post_type", "tags", "authorId", "createdAt"]
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have how i if in is it its of on or that the this to was "
+    "what when where which who why will with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+def _as_utc(value) -> Optional[datetime.datetime]:
+    if not isinstance(value, datetime.datetime):
+        return None
+    return value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+
+
+class ClassIndex:
+    def __init__(self):
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.lengths: Dict[str, int] = {}
+        self.posts: Dict[str, dict] = {}
+        self.total_length = 0
+        self._norms: Optional[Dict[str, float]] = None
+        self.synced_until: Optional[datetime.datetime] = None
+        self.synced_at = time.monotonic()
+
+    def add(self, post_id: str, post: dict):
+        """Index a post; re-adding a post id replaces the earlier entry"""
+        if post_id in self.posts:
+            self.remove(post_id)
+        terms = (tokenize(post.get("title") or "") + tokenize(" ".join(post.get("tags") or []))) * TITLE_WEIGHT
+        terms += tokenize(post.get("content") or "")
+        counts: Dict[str, int] = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[post_id] = tf
+        self.lengths[post_id] = len(terms)
+        self.total_length += len(terms)
+        self.posts[post_id] = {field: post.get(field) for field in POST_FIELDS}
+        self._norms = None
+
+    def remove(self, post_id: str):
+        if post_id not in self.posts:
+            return
+        for term in set(tokenize(self.posts[post_id].get("title") or "")
+                        + tokenize(" ".join(self.posts[post_id].get("tags") or []))
+                        + tokenize(self.posts[post_id].get("content") or "")):
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(post_id, None)
+                if not postings:
+                    del self.postings[term]
+        self.total_length -= self.lengths.pop(post_id)
+        del self.posts[post_id]
+        self._norms = None
+
+    def _length_norms(self) -> Dict[str, float]:
+        """BM25's per-post k1 * (1 - b + b * length / avg_length), recomputed after changes"""
+        if self._norms is None:
+            avg_length = self.total_length / len(self.posts) or 1
+            self._norms = {post_id: K1 * (1 - B + B * length / avg_length)
+                           for post_id, length in self.lengths.items()}
+        return self._norms
+
+    def search(self, terms: List[str], limit: int) -> List[Tuple[float, str]]:
+        """Top `limit` (score, post_id) pairs, best first"""
+        n = len(self.posts)
+        if not n:
+            return []
+        norms = self._length_norms()
+        scores: Dict[str, float] = {}
+        for term in set(terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            weight = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5)) * (K1 + 1)
+            for post_id, tf in postings.items():
+                scores[post_id] = scores.get(post_id, 0.0) + weight * tf / (tf + norms[post_id])
+        # Ties break on post id so the order is stable from page to page
+        return heapq.nlargest(limit, ((score, post_id) for post_id, score in scores.items()))
+
+    def note_synced(self, created_at):
+        created_at = _as_utc(created_at)
+        if created_at is not None and (self.synced_until is None or created_at > self.synced_until):
+            self.synced_until = created_at
+
+
+indexes = TTLCache(maxsize=SEARCH_INDEX_MAX_CLASSES, ttl=SEARCH_INDEX_TTL)
+# Per-class build locks, bounded like the indexes. Losing a lock to eviction
+# at worst lets two searches build the same index at once.
+_locks = TTLCache(maxsize=SEARCH_INDEX_MAX_CLASSES * 2, ttl=SEARCH_INDEX_TTL)
+
+
+def _posts_query(db, class_id: str):
+    return db.collection("classes").document(class_id).collection("posts").select(POST_FIELDS)
+
+
+def _index_docs(index: ClassIndex, docs):
+    for doc in docs:
+        post = doc.to_dict()
+        index.add(doc.id, post)
+        index.note_synced(post.get("createdAt"))
+
+
+async def build(db, class_id: str) -> ClassIndex:
+    """Build a class's index from scratch from its posts subcollection"""
+    index = ClassIndex()
+    docs = await query_docs(_posts_query(db, class_id))
+    # Nothing else can see the new index yet, so tokenising can happen off the event loop
+    await run_blocking(_index_docs, index, docs)
+    indexes.set(class_id, index)
+    return index
+
+
+async def _catch_up(db, class_id: str, index: ClassIndex):
+    """Index posts created since the last sync, including by other instances"""
+    query = _posts_query(db, class_id)
+    if index.synced_until is not None:
+        query = query.where("createdAt", ">", index.synced_until - SYNC_OVERLAP)
+    # Indexed on the event loop: searches may be reading this index, and the batch is small
+    _index_docs(index, await query_docs(query))
+    index.synced_at = time.monotonic()
+
+
+async def get_index(db, class_id: str) -> ClassIndex:
+    lock = _locks.get(class_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _locks.set(class_id, lock)
+    # One build or catch-up per class at a time; concurrent searches wait for it
+    async with lock:
+        index = indexes.get(class_id)
+        if index is None:
+            return await build(db, class_id)
+        if time.monotonic() - index.synced_at >= SEARCH_INDEX_REFRESH:
+            await _catch_up(db, class_id, index)
+        return index
+
+
+def add_post(class_id: str, post_id: str, post: dict):
+    """Add a newly created post to this instance's index for the class, if built"""
+    index = indexes.get(class_id)
+    if index is not None:
+        index.add(post_id, post)
+
+
+def forget(class_id: str):
+    indexes.invalidate(class_id)
+    _locks.invalidate(class_id)
+
+
+def snippet(text: str, terms: List[str], length: int = SNIPPET_CHARS) -> str:
+    """About `length` characters of `text` around the first matching term"""
+    wanted = set(terms)
+    start = 0
+    for match in _TOKEN_RE.finditer(text):
+        if match.group().lower() in wanted:
+            start = max(0, match.start() - length // 4)
+            break
+    if start:
+        # Don't cut a word in half
+        space = text.find(" ", start)
+        start = space + 1 if 0 <= space < start + 20 else start
+    end = min(len(text), start + length)
+    fragment = " ".join(text[start:end].split())
+    return ("…" if start else "") + fragment + ("…" if end < len(text) else "")
+
+
+def _query_fingerprint(terms: List[str]) -> str:
+    return hashlib.sha256(" ".join(terms).encode("utf-8")).hexdigest()[:12]
+
+
+def encode_cursor(terms: List[str], offset: int) -> str:
+    """Opaque cursor for the results after `offset`, tied to the query"""
+    return cursors.encode({"q": _query_fingerprint(terms), "o": offset})
+
+
+def decode_cursor(terms: List[str], cursor: str) -> int:
+    """Offset from encode_cursor; raises ValueError if malformed or for a different query"""
+    payload = cursors.decode(cursor)
+    try:
+        offset = int(payload["o"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if payload.get("q") != _query_fingerprint(terms) or offset < 0:
+        raise ValueError("Cursor does not match this query")
+    return offset
+
+
+def stats() -> dict:
+    return indexes.stats()
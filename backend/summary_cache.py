@@ -0,0 +1,97 @@
+"""Shared cache of structured note summaries.
+
+Results are keyed by a SHA-256 of the prompt version, the title and the
+whitespace-normalised content actually sent to the model, so the same slides
+uploaded by different students in a class reuse one summary. Lookups hit an
+in-process LRU first, then the `summary_cache` collection.
+
+Entries carry an `expires_at` (also usable as a Firestore TTL policy field)
+and the collection is trimmed to SUMMARY_CACHE_MAX_ENTRIES, oldest first.
+"""
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+from typing import Optional
+
+from cache import TTLCache
+from data_access import run_blocking, get_doc, query_docs, set_doc, delete_refs
+
+COLLECTION = "summary_cache"
+
+CACHE_TTL = datetime.timedelta(seconds=float(os.getenv("SUMMARY_CACHE_TTL", str(30 * 24 * 3600))))
+MAX_ENTRIES = int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", "5000"))
+
+# Check the collection size after this many writes on an instance
+PRUNE_EVERY_WRITES = 50
+
+local_cache = TTLCache(
+    maxsize=int(os.getenv("SUMMARY_CACHE_LOCAL_SIZE", "256")),
+    ttl=float(os.getenv("SUMMARY_CACHE_LOCAL_TTL", "3600")),
+)
+
+_writes_since_prune = 0
+_prune_tasks = set()
+
+
+def normalize_content(text: str) -> str:
+    return " ".join(text.split())
+
+
+def cache_key(content: str, title: Optional[str], prompt_version: str) -> str:
+    raw = json.dumps([prompt_version, title or "", normalize_content(content)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+async def get(db, key: str) -> Optional[dict]:
+    """Cached summary for `key`, or None on a miss or expired entry"""
+    summary = local_cache.get(key)
+    if summary is not None:
+        return summary
+
+    doc = await get_doc(db.collection(COLLECTION).document(key))
+    if not doc.exists:
+        return None
+    data = doc.to_dict()
+    remaining = (data["expires_at"] - _now()).total_seconds()
+    if remaining <= 0:
+        return None
+    local_cache.set(key, data["summary"], ttl=min(remaining, local_cache.ttl))
+    return data["summary"]
+
+
+async def put(db, key: str, summary: dict):
+    global _writes_since_prune
+    now = _now()
+    local_cache.set(key, summary)
+    await set_doc(db.collection(COLLECTION).document(key), {
+        "summary": summary,
+        "created_at": now,
+        "expires_at": now + CACHE_TTL,
+    })
+
+    _writes_since_prune += 1
+    if _writes_since_prune >= PRUNE_EVERY_WRITES:
+        _writes_since_prune = 0
+        task = asyncio.create_task(_prune(db))
+        _prune_tasks.add(task)
+        task.add_done_callback(_prune_tasks.discard)
+
+
+async def _prune(db):
+    """Drop the oldest entries once the collection grows past MAX_ENTRIES"""
+    try:
+        collection = db.collection(COLLECTION)
+        result = await run_blocking(lambda: collection.count().get())
+        excess = result[0][0].value - MAX_ENTRIES
+        if excess <= 0:
+            return
+        oldest = await query_docs(collection.order_by("created_at").limit(excess))
+        await delete_refs(db, [d.reference for d in oldest])
+    except Exception as e:
+        print(f"⚠️ Summary cache prune failed: {e}")
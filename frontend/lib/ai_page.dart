@@ -36,33 +36,76 @@ class _AIPageState extends State<AIPage> {
 
     _scrollToBottom();
 
-    try {
-      // Call your AI API
-      final response = await ApiService.chatWithAI(userMessage, conversationId: _conversationId);
-      
-      // Update conversation ID if this is first message
-      _conversationId ??= response['conversation_id'];
+    // Placeholder bubble that fills in as tokens arrive
+    final int replyIndex = _messages.length;
+    final buffer = StringBuffer();
+    setState(() {
+      _messages.add(ChatMessage(
+        text: '',
+        isUser: false,
+        timestamp: DateTime.now(),
+      ));
+    });
 
-      // Add AI response to chat
-      setState(() {
-        _messages.add(ChatMessage(
-          text: response['response'],
-          isUser: false,
-          timestamp: DateTime.now(),
-        ));
-      });
+    try {
+      var finished = false;
+      // Stream the AI reply token by token
+      await for (final event in ApiService.chatWithAIStream(userMessage, conversationId: _conversationId)) {
+        if (!mounted) break;
+        switch (event['event']) {
+          case 'start':
+            // Update conversation ID if this is first message
+            _conversationId ??= event['conversation_id'];
+            break;
+          case 'message':
+            buffer.write(event['delta'] ?? '');
+            setState(() {
+              _isLoading = false;
+              _messages[replyIndex] = ChatMessage(
+                text: buffer.toString(),
+                isUser: false,
+                timestamp: _messages[replyIndex].timestamp,
+              );
+            });
+            _scrollToBottom();
+            break;
+          case 'done':
+            finished = true;
+            break;
+          case 'error':
+            if (event['stage'] == 'save') {
+              // The reply arrived but was not stored in the conversation history
+              finished = true;
+              setState(() {
+                _messages[replyIndex] = ChatMessage(
+                  text: '${event['response'] ?? buffer.toString()}\n\n(This reply could not be saved to your conversation history.)',
+                  isUser: false,
+                  timestamp: _messages[replyIndex].timestamp,
+                  isError: true,
+                );
+              });
+              break;
+            }
+            throw Exception(event['detail'] ?? 'AI chat failed');
+        }
+      }
+      if (!finished && mounted) {
+        throw Exception('The connection closed before the reply finished');
+      }
     } catch (e) {
       // Handle errors
+      if (!mounted) return;
       setState(() {
-        _messages.add(ChatMessage(
+        _messages[replyIndex] = ChatMessage(
           text: 'Sorry, I encountered an error: ${e.toString()}',
           isUser: false,
           timestamp: DateTime.now(),
           isError: true,
-        ));
+        );
       });
     }
 
+    if (!mounted) return;
     setState(() {
       _isLoading = false;
     });
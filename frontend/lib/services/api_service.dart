@@ -170,6 +170,50 @@ class ApiService {
     }
   }
 
+  static Future<Map<String, dynamic>> getGradebook({
+    required String classId,
+    int studentLimit = 50,
+    String? studentCursor,
+    int assignmentLimit = 20,
+    int assignmentOffset = 0,
+    String? token,
+  }) async {
+    final headers = _buildHeaders(token: token);
+    final uri = Uri.parse('$baseUrl/classes/$classId/gradebook').replace(queryParameters: {
+      'student_limit': '$studentLimit',
+      if (studentCursor != null) 'student_cursor': studentCursor,
+      'assignment_limit': '$assignmentLimit',
+      'assignment_offset': '$assignmentOffset',
+    });
+    final response = await http.get(uri, headers: headers);
+    if (response.statusCode == 200) {
+      return jsonDecode(response.body);
+    } else {
+      throw Exception('Get gradebook failed: ${response.body}');
+    }
+  }
+
+  static Future<Map<String, dynamic>> searchPosts({
+    required String classId,
+    required String query,
+    int limit = 20,
+    String? cursor,
+    String? token,
+  }) async {
+    final headers = _buildHeaders(token: token);
+    final uri = Uri.parse('$baseUrl/classes/$classId/posts/search').replace(queryParameters: {
+      'q': query,
+      'limit': '$limit',
+      if (cursor != null) 'cursor': cursor,
+    });
+    final response = await http.get(uri, headers: headers);
+    if (response.statusCode == 200) {
+      return jsonDecode(response.body);
+    } else {
+      throw Exception('Search posts failed: ${response.body}');
+    }
+  }
+
   static Future<void> removeStudent({
     required String classId,
     required String studentId,
@@ -255,7 +299,8 @@ class ApiService {
       if (email != null && email.isNotEmpty) 'email': email,
     });
     final response = await http.delete(uri, headers: headers);
-    if (response.statusCode != 200) {
+    // 202: deletion continues in the background
+    if (response.statusCode != 200 && response.statusCode != 202) {
       throw Exception('Delete class failed: ${response.body}');
     }
   }
@@ -367,6 +412,57 @@ class ApiService {
         throw Exception('AI chat failed: ${response.body}');
       }
     }
+
+    // Streams the reply as server-sent events. Yields maps with an 'event' key:
+    // 'start' (conversation_id), 'message' (delta), 'done' (response) or 'error' (detail, and stage: 'model' or 'save').
+    // Cancelling the subscription closes the connection, which cancels the upstream request.
+    static Stream<Map<String, dynamic>> chatWithAIStream(
+      String message, {
+      String? conversationId,
+      String? token,
+      String? classContext,
+    }) async* {
+      final request = http.Request('POST', Uri.parse('$baseUrl/ai-study-buddy'));
+      request.headers.addAll(_buildHeaders(token: token));
+      request.headers['Accept'] = 'text/event-stream';
+      request.body = jsonEncode({
+        'message': message,
+        'stream': true,
+        if (conversationId != null) 'conversation_id': conversationId,
+        if (classContext != null) 'class_context': classContext,
+      });
+
+      final client = http.Client();
+      try {
+        final response = await client.send(request);
+        if (response.statusCode != 200) {
+          final body = await response.stream.bytesToString();
+          throw Exception('AI chat failed: $body');
+        }
+
+        String event = 'message';
+        final List<String> dataLines = <String>[];
+        final lines = response.stream
+            .transform(utf8.decoder)
+            .transform(const LineSplitter());
+        await for (final line in lines) {
+          if (line.isEmpty) {
+            if (dataLines.isNotEmpty) {
+              final Map<String, dynamic> data = jsonDecode(dataLines.join('\n'));
+              yield {'event': event, ...data};
+            }
+            event = 'message';
+            dataLines.clear();
+          } else if (line.startsWith('event:')) {
+            event = line.substring(6).trim();
+          } else if (line.startsWith('data:')) {
+            dataLines.add(line.substring(5).trim());
+          }
+        }
+      } finally {
+        client.close();
+      }
+    }
     
 
 }
\ No newline at end of file